@@ -0,0 +1,504 @@
+import time
+import asyncio
+from collections import namedtuple
+from UbiquitiManager.UbiExceptions import UbiHttpException
+from UbiquitiManager.UbiExceptions import UbiAuthException
+from UbiquitiManager.UbiResolver import DEFAULT_RESOLVER
+from UbiquitiManager.UbiJson import decode
+from UbiquitiManager.UbiConnector import UbiConnector
+from UbiquitiManager.UbiConnector import LOGIN_TIMEOUT
+from UbiquitiManager.UbiCredentialCache import DEFAULT_CREDENTIAL_CACHE
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+_AsyncResult = namedtuple(
+    '_AsyncResult',
+    ['status', 'content', 'url', 'content_type', 'encoding']
+)
+
+
+class AsyncUbiPool(object):
+    '''
+    Connection pool shared by AsyncUbiConnector instances. It bounds the
+    total number of opened connections and the number of connections to
+    a single device, and keeps them alive between requests.
+
+    Attributes
+    ----------
+    limit : int
+        Maximum number of simultaneous connections, 0 for no limit.
+    limit_per_host : int
+        Maximum number of simultaneous connections to a single device.
+
+    Methods
+    -------
+    connector()
+        Returns the aiohttp connector of the running event loop.
+    close()
+        Coroutine closing all the pooled connections.
+    '''
+    def __init__(self, limit=0, limit_per_host=2):
+        if aiohttp is None:
+            raise ImportError(
+                'aiohttp is required for AsyncUbiConnector, install '
+                'UbiquitiManager[async]'
+            )
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self._loop = None
+        self._connector = None
+
+    def connector(self):
+        '''
+        Returns the aiohttp connector of the running event loop, creating
+        it if needed.
+        '''
+        loop = asyncio.get_event_loop()
+        if self._connector is None or self._connector.closed or \
+                self._loop is not loop:
+            self._loop = loop
+            self._connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ssl=False
+            )
+        return self._connector
+
+    async def close(self):
+        '''
+        Closes all the pooled connections.
+        '''
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
+
+
+_DEFAULT_POOL = []
+
+
+def default_pool():
+    '''
+    Returns the pool used by connectors created without one.
+    '''
+    if not _DEFAULT_POOL:
+        _DEFAULT_POOL.append(AsyncUbiPool())
+    return _DEFAULT_POOL[0]
+
+
+class AsyncUbiConnector(object):
+    '''
+    AsyncUbiConnector is the asyncio counterpart of UbiConnector, meant to
+    poll thousands of devices from a single event loop. Every request
+    method is a coroutine, the connections come from a shared AsyncUbiPool
+    and the returned data and exceptions are the same as UbiConnector.
+
+    Attributes
+    ----------
+    host : str
+        Address of the host targeted for data gathering, resolved at
+        creation unless given as address (see UbiResolver.load_inventory).
+    name : str
+        Name of the device, see UbiConnector.name.
+    login : str
+        Login crediential to access the target.
+    passwords : list
+        List of str, containing potential passwords crediential to access
+        the target.
+    protocol : str
+        Use http or https for eccessing the device
+    port : str
+        strcontaining the port number to access te device.
+    baseurl : str
+        url validated after authentication.
+    data : dict
+        for every page requested will store latest gathered data, unless
+        retain_data is False.
+    retain_data : bool
+        Keep the JSON results in data.
+    pool : AsyncUbiPool
+        Connection pool used for the requests.
+    stats : dict
+        Same counters as UbiConnector.stats.
+    metrics : UbiquitiManager.UbiMetrics.UbiMetrics
+        Optional recorder, see UbiConnector.metrics.
+
+    Methods
+    -------
+    ubi_authentication(force=False, timeout=LOGIN_TIMEOUT)
+        Coroutine, attemps authentication to the device.
+    ubi_request_post(path, data)
+        Coroutine, posts data as multipart/form-data to the given path.
+    ubi_request_get(path)
+        Coroutine, gathers data via get to the given path.
+    ubi_add_password(other_password)
+        Extend the possible passwords list.
+    close()
+        Coroutine, closes the session (the pool is kept).
+    '''
+
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, host, login, password, protocol='https', port=443,
+                 credential_cache=None, pool=None, address=None,
+                 resolver=None, metrics=None, retain_data=True):
+        self.hostname = str(host)
+        self.host = address
+        if not address:
+            self.host = (resolver or DEFAULT_RESOLVER).resolve(self.hostname)
+
+        self.login = str(login)
+        if isinstance(password, list):
+            self.passwords = [str(p) for p in password]
+        else:
+            self.passwords = [str(password)]
+        self.protocol = protocol
+        self.port = str(port)
+        self.baseurl = None
+        self.data = {}
+        self.retain_data = retain_data
+        self.session = None
+        self.pool = pool
+        if pool is None:
+            self.pool = default_pool()
+        self.credential_cache = credential_cache
+        if credential_cache is None:
+            self.credential_cache = DEFAULT_CREDENTIAL_CACHE
+        self.metrics = metrics
+        self._metrics_host = self.hostname
+        if self.port not in ('80', '443'):
+            self._metrics_host = '{}:{}'.format(self.hostname, self.port)
+        self.stats = {
+            'logins': 0,
+            'logins_avoided': 0,
+            'session_expired': 0,
+            'login_attempts': 0,
+        }
+
+    @property
+    def name(self):
+        '''
+        Name of the device, see UbiConnector.name.
+        '''
+        return self._metrics_host
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @staticmethod
+    def _timeout(timeout):
+        if isinstance(timeout, tuple):
+            return aiohttp.ClientTimeout(
+                sock_connect=timeout[0],
+                sock_read=timeout[1]
+            )
+        return aiohttp.ClientTimeout(total=timeout)
+
+    @staticmethod
+    def _multipart(data):
+        writer = aiohttp.MultipartWriter('form-data')
+        for key, value in data.items():
+            filename = None
+            if isinstance(value, tuple):
+                filename, value = value
+            if filename is None:
+                part = writer.append(str(value))
+                part.set_content_disposition('form-data', name=key)
+            else:
+                part = writer.append(value)
+                part.set_content_disposition(
+                    'form-data',
+                    name=key,
+                    filename=filename
+                )
+        return writer
+
+    def _new_session(self):
+        return aiohttp.ClientSession(
+            connector=self.pool.connector(),
+            connector_owner=False,
+            cookie_jar=aiohttp.CookieJar(unsafe=True)
+        )
+
+    async def ubi_authentication(self, force=False, timeout=LOGIN_TIMEOUT):
+        '''
+        Attemps authentication to the device, Raise exception if failed to log
+        in. Like UbiConnector.ubi_authentication the session is kept and
+        reused until the device expires it or force is used.
+
+        Parameters
+        ----------
+        force : bool, optional
+            Log in again even if a session is already opened.
+        timeout : tuple, optional
+            Time outs of each login.cgi request.
+
+        Raises
+        ------
+        UbiAuthException
+            if none of the login:pawwsords worked.
+        '''
+        if self.baseurl is not None and not force:
+            self.stats['logins_avoided'] += 1
+            return
+        self.stats['logins'] += 1
+        start = time.perf_counter()
+        if self.session is None or self.session.closed:
+            self.session = self._new_session()
+        try:
+            await self._login(start, self._timeout(timeout))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as excpt:
+            if self.metrics is not None:
+                self.metrics.error(self._metrics_host, 'login.cgi', excpt)
+            raise
+
+    async def _login(self, start, timeout):
+        '''
+        Posts the passwords to login.cgi until one works.
+        '''
+        attempts = 0
+        base_url = '{0}://{1}:{2}'.format(
+            self.protocol,
+            self.host,
+            self.port
+        )
+        async with self.session.get(
+                '{}/login.cgi'.format(base_url),
+                timeout=timeout) as data:
+            await data.read()
+        for password in self.credential_cache.order(self.host, self.passwords):
+            self.stats['login_attempts'] += 1
+            attempts += 1
+            async with self.session.post(
+                    '{}/login.cgi'.format(base_url),
+                    data=self._multipart({
+                        'username': self.login,
+                        'password': password,
+                        'uri': ''
+                    }),
+                    timeout=timeout) as data:
+                text = await data.text(errors='replace')
+            if not UbiConnector._is_login_page(text):
+                self.baseurl = base_url
+                self.credential_cache.set(self.host, password)
+                if self.metrics is not None:
+                    self.metrics.login(
+                        self._metrics_host,
+                        attempts,
+                        True,
+                        time.perf_counter() - start
+                    )
+                return
+        self.credential_cache.forget(self.host)
+        self.baseurl = None
+        excpt = UbiAuthException('Authentication Failed')
+        if self.metrics is not None:
+            self.metrics.login(
+                self._metrics_host,
+                attempts,
+                False,
+                time.perf_counter() - start
+            )
+            self.metrics.error(self._metrics_host, 'login.cgi', excpt)
+        raise excpt
+
+    async def _send(self, method, path, timeout, data=None):
+        login_timeout = UbiConnector._login_timeout(timeout)
+        if self.baseurl is None:
+            await self.ubi_authentication(timeout=login_timeout)
+        positions = {}
+        for key, value in (data or {}).items():
+            if isinstance(value, tuple) and hasattr(value[1], 'seek'):
+                positions[key] = value[1].tell()
+        for attempt in range(2):
+            if attempt:
+                self.stats['session_expired'] += 1
+                await self.ubi_authentication(
+                    force=True,
+                    timeout=login_timeout
+                )
+                for key, position in positions.items():
+                    data[key][1].seek(position)
+            result = await self._request(method, path, timeout, data)
+            if '/login.cgi' not in result.url and (
+                    b'logintable' not in result.content or
+                    not UbiConnector._is_login_page(self._text(result))):
+                break
+        return result
+
+    @staticmethod
+    def _text(result):
+        return result.content.decode(result.encoding, 'replace')
+
+    async def _request(self, method, path, timeout, data):
+        '''
+        One HTTP exchange over the session, recorded in metrics if set.
+        '''
+        body = None if data is None else self._multipart(data)
+        start = time.perf_counter()
+        try:
+            async with self.session.request(
+                    method,
+                    '{}/{}'.format(self.baseurl, path),
+                    data=body,
+                    timeout=self._timeout(timeout)) as result:
+                answer = _AsyncResult(
+                    result.status,
+                    await result.read(),
+                    str(result.url),
+                    result.headers.get('Content-Type'),
+                    result.get_encoding()
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as excpt:
+            if self.metrics is not None:
+                self.metrics.error(self._metrics_host, path, excpt)
+            raise
+        if self.metrics is not None:
+            self.metrics.request(
+                self._metrics_host,
+                path,
+                method,
+                answer.status,
+                time.perf_counter() - start,
+                0 if body is None else body.size or 0,
+                len(answer.content)
+            )
+        return answer
+
+    def _treat_http_return(self, result, path):
+        if result.status < 200 or result.status > 299:
+            excpt = UbiHttpException(
+                'Http server returned Code {}'.format(
+                    result.status
+                )
+            )
+            if self.metrics is not None:
+                self.metrics.error(self._metrics_host, path, excpt)
+            raise excpt
+        try:
+            is_json, data = decode(result.content_type, result.content)
+        except ValueError:
+            if self.metrics is not None:
+                self.metrics.parse_failure(self._metrics_host, path)
+            return self._text(result)
+        if not is_json:
+            return self._text(result)
+        if self.retain_data:
+            self.data[path] = data
+        return data
+
+    async def ubi_request_post(self, path, data, timeout=(3, 250)):
+        '''
+        Attemps to gather data via post to the given path, setting encoding
+        type to multipart/form-data.
+
+        Parameters
+        ----------
+        path : str
+            path to add to the base connection url.
+        data : dict
+            parameter to post to the given path. With key=form_id and and
+            value=form_value, if you want to add filename use a tuple in the
+            value as (filename, value)
+        timeout : tuple optional
+            Time outs for genereal purpose requests. By default, will wait
+            3 seconds for tcp connection, and 250s for answer.
+
+        Returns
+        -------
+        result : dict or str
+            if the output was readable json returns the dict loaded from the
+            json, else return text data.
+
+        Raises
+        ------
+        UbiHttpException
+            if http return code was not of type 2xx.
+        '''
+        result = await self._send('POST', path, timeout, data=data)
+        return self._treat_http_return(result, path)
+
+    async def ubi_request_get(self, path, timeout=(3, 250)):
+        '''
+        Attemps to gather data via get to the given path.
+
+        Parameters
+        ----------
+        path : str
+            path to add to the base connection url.
+        timeout : tuple optional
+            Time outs for genereal purpose requests. By default, will wait
+            3 seconds for tcp connection, and 250s for answer.
+
+        Returns
+        -------
+        result : dict or str
+            if the output was readable json returns the dict loaded from the
+            json, else return text data.
+
+        Raises
+        ------
+        UbiHttpException
+            if http return code was not of type 2xx.
+        '''
+        result = await self._send('GET', path, timeout)
+        return self._treat_http_return(result, path)
+
+    def ubi_add_password(self, other_password):
+        '''
+        Add one or more possible passwords.
+
+        Parameters
+        ----------
+        other_password : str or list
+            Adds the password or the list of password to the potential
+            passwords.
+        '''
+        if isinstance(other_password, list):
+            self.passwords.extend([str(p) for p in other_password])
+        else:
+            self.passwords.append(str(other_password))
+
+    async def close(self):
+        '''
+        Closes the session of the connector. Pooled connections stay open
+        for the other connectors.
+        '''
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        self.baseurl = None
+
+
+async def async_fleet_get(connectors, path, timeout=(3, 250)):
+    '''
+    Gets the same path on many devices at once.
+
+    Parameters
+    ----------
+    connectors : list
+        List of AsyncUbiConnector.
+    path : str
+        path to get on every device, like 'status.cgi'.
+    timeout : tuple optional
+        Time outs passed to ubi_request_get.
+
+    Returns
+    -------
+    results : list
+        Data returned by every device in the connectors order, or the
+        exception raised for that device.
+    '''
+    return await asyncio.gather(
+        *[
+            connector.ubi_request_get(path, timeout)
+            for connector in connectors
+        ],
+        return_exceptions=True
+    )
@@ -0,0 +1,77 @@
+import time
+import random
+from UbiquitiManager.UbiExceptions import UbiTimeoutException
+
+
+def backoff_delays(initial=0.5, maximum=5, factor=2, jitter=0):
+    '''
+    Infinite generator of exponentially growing delays.
+
+    Parameters
+    ----------
+    initial : float
+        First delay in seconds.
+    maximum : float
+        Delays never grow above this value.
+    factor : float
+        Each delay is the previous one multiplied by factor.
+    jitter : float
+        Fraction of the delay randomly removed, 0.5 gives delays between
+        half and the full value. Avoids many callers retrying in sync.
+    '''
+    delay = initial
+    while True:
+        yield delay * (1 - random.random() * jitter)
+        delay = min(delay * factor, maximum)
+
+
+def wait_until(probe, deadline, initial=0.5, maximum=5, factor=2,
+               min_wait=0):
+    '''
+    Calls probe until it returns a true value without raising, sleeping
+    with exponential backoff between calls.
+
+    Parameters
+    ----------
+    probe : callable
+        Called without argument, a false result or an exception means the
+        condition is not met yet.
+    deadline : float
+        Seconds after which we give up.
+    initial, maximum, factor : float
+        See backoff_delays.
+    min_wait : float
+        Seconds to wait before the first call.
+
+    Returns
+    -------
+    elapsed : float
+        Seconds it took for the probe to succeed.
+
+    Raises
+    ------
+    UbiTimeoutException
+        If the probe did not succeed before deadline. The last error of
+        the probe is available as the last_error attribute.
+    '''
+    start = time.time()
+    last_error = None
+    time.sleep(min_wait)
+    for delay in backoff_delays(initial, maximum, factor):
+        try:
+            if probe():
+                return time.time() - start
+        except Exception as excpt:
+            last_error = excpt
+        remaining = start + deadline - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+    error = UbiTimeoutException(
+        'Condition not met after {}s. Last error : {}'.format(
+            deadline,
+            str(last_error)
+        )
+    )
+    error.last_error = last_error
+    raise error
@@ -0,0 +1,236 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Numeric columns of the table: name, candidate paths in a sta.cgi client
+# (the first one present is used, dotted for nested dicts) and dtype.
+CLIENT_COLUMNS = (
+    ('signal', ('signal',), 'f4'),
+    ('rssi', ('rssi',), 'f4'),
+    ('noisefloor', ('noisefloor',), 'f4'),
+    ('ccq', ('ccq',), 'f4'),
+    ('tx_rate', ('tx', 'tx_rate'), 'f4'),
+    ('rx_rate', ('rx', 'rx_rate'), 'f4'),
+    ('airtime', ('airtime', 'remote.airtime', 'airmax.quality'), 'f4'),
+    ('distance', ('distance',), 'f4'),
+    ('tx_latency', ('tx_latency',), 'f4'),
+    ('uptime', ('uptime',), 'f8'),
+    ('tx_bytes', ('stats.tx_bytes',), 'f8'),
+    ('rx_bytes', ('stats.rx_bytes',), 'f8'),
+)
+
+
+def _getter(paths):
+    '''
+    Returns a function reading the first present path of a client dict,
+    NaN when none is present or the value is not a number.
+    '''
+    split_paths = [path.split('.') for path in paths]
+
+    def get(client):
+        for path in split_paths:
+            value = client
+            for key in path:
+                if not isinstance(value, dict) or key not in value:
+                    value = None
+                    break
+                value = value[key]
+            if value is not None:
+                try:
+                    return float(value)
+                except (TypeError, ValueError):
+                    return float('nan')
+        return float('nan')
+    return get
+
+
+class UbiClientTable(object):
+    '''
+    Wireless clients of many access points as NumPy columns, for fleet
+    wide vectorized queries. Each client is a row: mac is a fixed width
+    bytes column, ap_index points in aps, and the numeric fields of
+    CLIENT_COLUMNS are typed arrays with NaN for missing values.
+
+    Requires numpy (pip install UbiquitiManager[analytics]).
+
+    Attributes
+    ----------
+    aps : list
+        Access point of each ap_index value.
+    columns : dict
+        Column name to numpy array, all of the same length.
+
+    Methods
+    -------
+    from_results(results)
+        Builds a table from sta.cgi results of many APs.
+    take(indices)
+        Returns a table restricted to the given rows.
+    rows(indices=None)
+        Returns rows as dicts.
+    worst_signal(count=10)
+        Clients with the lowest signal.
+    per_ap_percentile(column, percentile)
+        Percentile of a column for every AP.
+    roaming_candidates(signal=-75, ccq=None)
+        Clients with a weak link.
+    '''
+    def __init__(self, aps, columns):
+        if np is None:
+            raise ImportError(
+                'numpy is required for UbiClientTable, install '
+                'UbiquitiManager[analytics]'
+            )
+        self.aps = list(aps)
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['mac'])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    @classmethod
+    def from_results(cls, results):
+        '''
+        Builds a table from the sta.cgi data of many APs, like returned by
+        UbiConfigManager.wirless_clients.
+
+        Parameters
+        ----------
+        results : dict or iterable
+            AP to list of client dicts, or iterable of (AP, clients) or
+            UbiFleetResult / UbiPollResult. Failed results are skipped. APs
+            of fleet results are named by their key, those of poll results
+            by their host (both host:port when the port is not 80 or 443).
+
+        Returns
+        -------
+        table : UbiClientTable
+        '''
+        if np is None:
+            raise ImportError(
+                'numpy is required for UbiClientTable, install '
+                'UbiquitiManager[analytics]'
+            )
+        if isinstance(results, dict):
+            results = results.items()
+        aps = []
+        clients_per_ap = []
+        for result in results:
+            if hasattr(result, 'error'):
+                if result.error is not None:
+                    continue
+                if hasattr(result, 'data'):
+                    result = (result.host, result.data)
+                else:
+                    result = (result.key, result.result)
+            ap, clients = result
+            if not isinstance(clients, list):
+                continue
+            aps.append(ap)
+            clients_per_ap.append(clients)
+        total = sum(len(clients) for clients in clients_per_ap)
+        columns = {
+            'mac': np.zeros(total, dtype='S17'),
+            'ap_index': np.empty(total, dtype='i4'),
+        }
+        getters = []
+        for name, paths, dtype in CLIENT_COLUMNS:
+            columns[name] = np.empty(total, dtype=dtype)
+            getters.append((columns[name], _getter(paths)))
+        row = 0
+        for ap_index, clients in enumerate(clients_per_ap):
+            end = row + len(clients)
+            columns['ap_index'][row:end] = ap_index
+            for client in clients:
+                columns['mac'][row] = str(
+                    client.get('mac', '')
+                ).upper().encode('ascii', 'replace')[:17]
+                for column, get in getters:
+                    column[row] = get(client)
+                row += 1
+        return cls(aps, columns)
+
+    def take(self, indices):
+        '''
+        Returns a table restricted to the given rows (index array or
+        boolean mask).
+        '''
+        return UbiClientTable(
+            self.aps,
+            {name: column[indices] for name, column in self.columns.items()}
+        )
+
+    def rows(self, indices=None):
+        '''
+        Returns the rows as dicts, with the AP instead of ap_index.
+        '''
+        table = self if indices is None else self.take(indices)
+        rows = []
+        for row in range(len(table)):
+            values = {
+                name: column[row].item()
+                for name, column in table.columns.items()
+            }
+            values['mac'] = values['mac'].decode('ascii')
+            values['ap'] = self.aps[values.pop('ap_index')]
+            rows.append(values)
+        return rows
+
+    def worst_signal(self, count=10):
+        '''
+        Returns the table of the count clients with the lowest signal,
+        weakest first.
+        '''
+        signal = self.columns['signal']
+        known = np.flatnonzero(~np.isnan(signal))
+        order = known[np.argsort(signal[known], kind='stable')]
+        return self.take(order[:count])
+
+    def per_ap_percentile(self, column, percentile):
+        '''
+        Computes a percentile of a column for every AP at once, ignoring
+        missing values.
+
+        Parameters
+        ----------
+        column : str
+            Column name, like 'signal' or 'ccq'.
+        percentile : float
+            Percentile between 0 and 100.
+
+        Returns
+        -------
+        values : numpy.ndarray
+            One value per AP (in aps order), NaN for APs without data.
+        '''
+        values = self.columns[column].astype('f8')
+        ap_index = self.columns['ap_index']
+        known = ~np.isnan(values)
+        values, ap_index = values[known], ap_index[known]
+        order = np.lexsort((values, ap_index))
+        values, ap_index = values[order], ap_index[order]
+        counts = np.bincount(ap_index, minlength=len(self.aps))
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        result = np.full(len(self.aps), np.nan)
+        has_data = counts > 0
+        position = starts[has_data] + \
+            (counts[has_data] - 1) * (percentile / 100.0)
+        lower = np.floor(position).astype('i8')
+        upper = np.ceil(position).astype('i8')
+        weight = position - lower
+        result[has_data] = values[lower] * (1 - weight) + \
+            values[upper] * weight
+        return result
+
+    def roaming_candidates(self, signal=-75, ccq=None):
+        '''
+        Returns the table of clients with a signal below the threshold (in
+        dBm), or a CCQ below ccq when given.
+        '''
+        mask = self.columns['signal'] < signal
+        if ccq is not None:
+            mask |= self.columns['ccq'] < ccq
+        return self.take(mask)
@@ -4,26 +4,73 @@ import random
 from io import StringIO
 from crypt import crypt
 from functools import reduce
+from contextlib import ExitStack
+from collections import namedtuple
 from UbiquitiManager.UbiExceptions import UbiConfigTest
 from UbiquitiManager.UbiExceptions import UbiBadFirmware
 from UbiquitiManager.UbiExceptions import UbiAuthException
 from UbiquitiManager.UbiExceptions import UbiAlertConnectivityLost
 from UbiquitiManager.UbiExceptions import UbiConfigChangeFailed
+from UbiquitiManager.UbiExceptions import UbiTimeoutException
+from UbiquitiManager.UbiBackoff import wait_until
+from UbiquitiManager.UbiUpload import UbiFirmwareImage
+from UbiquitiManager.UbiConfigStore import LEAF_KEY
+from UbiquitiManager.UbiConfigStore import UbiConfigStore
+
+UbiUpgradeResult = namedtuple(
+    'UbiUpgradeResult',
+    ['upload_time', 'flash_time', 'reachable_time', 'login_time', 'total_time']
+)
+UbiUpgradeResult.__doc__ = '''
+Durations in seconds of a firmware upgrade: upload of the image, flash
+until the device went down (or answered with a reset uptime), reboot until
+its TCP port answered, then until the login succeeded, and the total.
+'''
+
+
+def _deadline_timeout(deadline, maximum=None):
+    '''
+    Time outs of a request which must be over by deadline (a time.time()
+    value): 3 seconds to connect, the remaining time, or maximum, to read.
+    '''
+    remaining = max(deadline - time.time(), 0.1)
+    if maximum is not None:
+        remaining = min(remaining, maximum)
+    return (min(3, remaining), remaining)
 
 
 class UbiConfigManager(object):
     '''
     This class will allow you to gather, manipulate and push configuration
-    file contained in an ubiquiti device.
+    file contained in an ubiquiti device. The configuration is gathered
+    from the device on first use of config, config_dict, store or of a
+    method needing it, unless it is given at creation.
 
     Attributes
     ----------
     connector : UbiquitiManager.UbiConnector
         Connector Object.
     config : str
-        Text configuration
+        Text configuration. Edits made with set_value or change_password
+        go to the store, the text is rebuilt only when it is read, in the
+        original line order.
+    store : UbiquitiManager.UbiConfigStore.UbiConfigStore
+        Flat configuration, source of the text and of config_dict.
+    device_store : UbiquitiManager.UbiConfigStore.UbiConfigStore
+        Configuration as last gathered from or pushed to the device.
+    push_pending : bool
+        True between a push_config_start which uploaded a config and its
+        push_config_confirm.
     config_dict : dict
-        Configuration converted in dict od dict of dict etc...
+        Configuration converted in dict od dict of dict etc... When a key
+        is also the prefix of other keys, its value is stored under the
+        LEAF_KEY ('=') key of its dict. Built from the store on first use,
+        call config_dict_to_text after modifying it directly.
+    test_started : float
+        Time the config test was started by push_config_start, None when no
+        test is waiting for confirmation.
+    last_recovery_time : float
+        Seconds the device took to answer again during the last config test.
 
     Methods
     -------
@@ -35,55 +82,113 @@ class UbiConfigManager(object):
         gather the config from the device.
     push_config()
         Push and saves configuration to device.
+    push_config_start()
+        Push configuration to device and start testing it.
+    push_config_confirm()
+        Wait for the device to survive the test and save configuration.
+    diff_config(desired=None)
+        Differences between the device config and the wanted one.
+    apply_template(template, variables=None)
+        Applies a UbiConfigTemplate policy to the configuration.
     '''
-    def __init__(self, ubiquiti_connector):
+    def __init__(self, ubiquiti_connector, config_text=None):
+        '''
+        Parameters
+        ----------
+        ubiquiti_connector : UbiquitiManager.UbiConnector
+            Connector Object.
+        config_text : str, optional
+            Configuration already fetched from the device (or cached),
+            used instead of gathering it.
+        '''
         self.connector = ubiquiti_connector
-        self.config = None
-        self.config_dict = {}
-        self.gather_config()
+        self._loaded = False
+        self._store = UbiConfigStore()
+        self._config = None
+        self._config_stale = False
+        self._config_dict = None
+        self.device_store = None
+        self.push_pending = False
+        self.test_started = None
+        self.last_recovery_time = None
+        self._test_uptime = (None, None)
+        if config_text is not None:
+            self.config = config_text
+            self.device_store = self.store.copy()
+
+    def _ensure_config(self):
+        if not self._loaded:
+            self.gather_config()
+
+    @property
+    def store(self):
+        self._ensure_config()
+        return self._store
+
+    @store.setter
+    def store(self, store):
+        self._store = store
+        self._loaded = True
+
+    @property
+    def config(self):
+        self._ensure_config()
+        if self._config_stale:
+            self._config = self.store.to_text()
+            self._config_stale = False
+        return self._config
+
+    @config.setter
+    def config(self, text):
+        self._config = text
+        self._config_stale = False
+        self.store = UbiConfigStore.from_text(text)
+        self._config_dict = None
+
+    @property
+    def config_dict(self):
+        self._ensure_config()
+        if self._config_dict is None:
+            self._config_dict = self.store.to_dict()
+        return self._config_dict
+
+    @config_dict.setter
+    def config_dict(self, config_dict):
+        self._loaded = True
+        self._config_dict = config_dict
+        self.config_dict_to_text()
+
+    def _store_value(self, k_list, value):
+        if self._config_dict is not None:
+            self._set_to_dict(k_list, value)
+        self.store.set('.'.join(k_list), value)
+        self._config_stale = True
 
     def _get_from_dict(self, k_list):
         return reduce(lambda data, key: data[key], k_list, self.config_dict)
 
     def _set_to_dict(self, k_list, value):
-        self._get_from_dict(k_list[:-1])[k_list[-1]] = value
+        parent = self._get_from_dict(k_list[:-1])
+        if isinstance(parent.get(k_list[-1]), dict):
+            parent[k_list[-1]][LEAF_KEY] = value
+        else:
+            parent[k_list[-1]] = value
 
     def config_text_to_dict(self):
         '''
-        Takes the text configuation and convert it to dict.
+        Takes the text configuation and convert it to dict. The store is
+        parsed again from the text and config_dict rebuilt on next use.
         '''
-        for line in str(self.config).splitlines():
-            key = line.split('=')[0]
-            value = '='.join(line.split('=')[1:])
-            tmp_dict = self.config_dict
-            for element in key.split('.'):
-                if element not in tmp_dict:
-                    tmp_dict[element] = {}
-                tmp_dict = tmp_dict[element]
-            self._set_to_dict(key.split('.'), value)
+        self.config = self.config
 
     def config_dict_to_text(self):
         '''
-        Takes the dict configuation and convert it to text.
-        '''
-        def parse_dict(thisdict, path=''):
-            '''
-            Recurcive Function for converting embeded dict keys
-            in new keys for the previous dict.
-            '''
-            ret = {}
-            for nextpath, val in thisdict.items():
-                newpath = path+nextpath
-                if isinstance(val, dict):
-                    ret.update(parse_dict(val, newpath+'.'))
-                else:
-                    ret[newpath] = val
-            return ret
-        final_dict = parse_dict(self.config_dict)
-        result = []
-        for key, value in sorted(final_dict.items()):
-            result.append('{}={}'.format(key, value))
-        self.config = '\n'.join(result)
+        Takes the dict configuation and convert it to text, keys sorted.
+        '''
+        store = UbiConfigStore.from_dict(self.config_dict)
+        store.newline = self._store.newline
+        self.store = store
+        self._config_stale = True
 
     def gather_config(self):
         '''
@@ -92,25 +197,57 @@ class UbiConfigManager(object):
         '''
         self.connector.ubi_authentication()
         self.config = self.connector.ubi_request_get('cfg.cgi')
-        self.config_text_to_dict()
+        self.device_store = self.store.copy()
 
-    def push_config(self, avoid_test=False):
+    def diff_config(self, desired=None):
         '''
-        Push textual config to the ubiquiti device. Then Run test on the
-        config. If after test the ubuquiti device is still answering, it
-        will apply the configuration definitely.
+        Compares the configuration of the device, as gathered, with the
+        wanted one.
+
+        Parameters
+        ----------
+        desired : UbiConfigStore or str, optional
+            Wanted configuration, by default the current one of the manager.
+
+        Returns
+        -------
+        diff : UbiquitiManager.UbiConfigStore.UbiConfigDiff
+            Keys added, removed and changed compared to the device, false
+            when there is nothing to push.
+        '''
+        if desired is None:
+            desired = self.store
+        elif not isinstance(desired, UbiConfigStore):
+            desired = UbiConfigStore.from_text(desired)
+        self._ensure_config()
+        device_store = self.device_store
+        if device_store is None:
+            device_store = UbiConfigStore()
+        return device_store.diff(desired)
+
+    def push_config_start(self, avoid_test=False, force=False):
+        '''
+        First half of push_config: uploads the textual config and starts the
+        test mode, without waiting for the device. Call push_config_confirm
+        afterwards, this allows to start the test on many devices and to
+        confirm them together. Nothing is done when the config does not
+        differ from the device one.
 
         Parameters
         ----------
         avoid_test : bool
             Default is False, if you want to apply the config no matter what,
             you can use avoid_test=True.
+        force : bool
+            Push even if the config did not change.
 
-        Raises
-        ------
-        UbiConfigTest
-            If the device is not reachable after test.
+        Returns
+        -------
+        pushed : bool
+            False if the push was skipped.
         '''
+        if not force and not self.diff_config():
+            return False
         self.connector.ubi_authentication()
         config_file = StringIO(self.config)
         config_file.seek(0)
@@ -122,20 +259,96 @@ class UbiConfigManager(object):
                 'action': 'cfgupload'
             }
         )
+        self.test_started = None
         if not avoid_test:
+            self._test_uptime = self._uptime()
             self.connector.ubi_request_post(
                 'apply.cgi',
                 {
                     'testmode': 'on',
                 }
             )
-            time.sleep(20)
+            self.test_started = time.time()
+        self.push_pending = True
+        del result
+        return True
+
+    def push_config_confirm(self, test_timeout=120, min_wait=2,
+                            probe_timeout=(3, 10), restart_wait=20):
+        '''
+        Second half of push_config: if a test was started, waits for the
+        device to restart with the test config, polls it with backoff until
+        it answers again, then applies the configuration definitely. The
+        time the device took to answer is stored in last_recovery_time.
+        Does nothing if push_config_start skipped the push. The probes
+        bypass the circuit breaker of the connector, the device is expected
+        to be down while it applies the test config.
+
+        The restart is seen when the device stops accepting connections or
+        reports a reset uptime. An answer before that could come from the
+        old config, which would then be applied without its connectivity
+        being tested, so it is only accepted once restart_wait seconds went
+        by without seeing the restart (a config not restarting the network,
+        or a drop shorter than the probe interval).
+
+        Parameters
+        ----------
+        test_timeout : float, optional
+            Seconds given to the device to answer again after the test was
+            started.
+        min_wait : float, optional
+            Seconds to leave to the device to start applying the test
+            config before probing it.
+        probe_timeout : tuple, optional
+            Time outs of each probe request.
+        restart_wait : float, optional
+            Seconds after the test was started from which an answer is
+            accepted even if the restart was not seen.
+
+        Raises
+        ------
+        UbiConfigTest
+            If the device is not reachable after test.
+        '''
+        if not self.push_pending:
+            return
+        if self.test_started is not None:
+            remaining_wait = self.test_started + min_wait - time.time()
+            deadline = self.test_started + test_timeout
+            uptime, read_at = self._test_uptime
+            restarted = []
+
+            def recovered():
+                if not restarted:
+                    if not self.connector.ubi_tcp_probe(timeout=1):
+                        restarted.append(True)
+                        return False
+                    if uptime is not None and \
+                            self._rebooted(uptime, read_at, deadline):
+                        restarted.append(True)
+                    elif time.time() < self.test_started + restart_wait:
+                        return False
+                return self.connector.ubi_request_get(
+                    'system.cgi',
+                    timeout=probe_timeout,
+                    use_breaker=False
+                ) is not None
+
             try:
-                result = self.connector.ubi_request_get('system.cgi')
-            except Exception as excpt:
+                wait_until(
+                    recovered,
+                    deadline - time.time(),
+                    maximum=2,
+                    min_wait=max(0, remaining_wait)
+                )
+            except UbiTimeoutException as excpt:
                 raise UbiConfigTest(
-                    'Configuration Test Failed. Error : {}'.format(str(excpt))
+                    'Configuration Test Failed. Error : {}'.format(
+                        str(excpt.last_error)
+                    )
                 )
+            self.last_recovery_time = time.time() - self.test_started
+            self.test_started = None
 
         result = self.connector.ubi_request_post(
             'apply.cgi',
@@ -143,8 +356,55 @@ class UbiConfigManager(object):
                 'testmode': '',
             }
         )
+        self.push_pending = False
+        self.device_store = self.store.copy()
         del result
 
+    def push_config(self, avoid_test=False, test_timeout=120, min_wait=2,
+                    force=False, restart_wait=20):
+        '''
+        Push textual config to the ubiquiti device. Then Run test on the
+        config. As soon as the ubuquiti device is answering again after the
+        test, it will apply the configuration definitely. The push is skipped
+        when the config does not differ from the device one (see
+        diff_config).
+
+        Parameters
+        ----------
+        avoid_test : bool
+            Default is False, if you want to apply the config no matter what,
+            you can use avoid_test=True.
+        test_timeout : float, optional
+            Seconds given to the device to answer again after the test was
+            started.
+        min_wait : float, optional
+            Seconds to leave to the device to start applying the test
+            config before probing it.
+        force : bool, optional
+            Push even if the config did not change.
+        restart_wait : float, optional
+            Seconds after which an answer is accepted even if the test
+            restart of the device was not seen, see push_config_confirm.
+
+        Returns
+        -------
+        pushed : bool
+            False if the push was skipped.
+
+        Raises
+        ------
+        UbiConfigTest
+            If the device is not reachable after test.
+        '''
+        if not self.push_config_start(avoid_test, force):
+            return False
+        self.push_config_confirm(
+            test_timeout,
+            min_wait,
+            restart_wait=restart_wait
+        )
+        return True
+
     def set_value(self, config_path, value):
         '''
         Grab a config Path either in the form of a list of keys, or textual,
@@ -168,8 +428,33 @@ class UbiConfigManager(object):
             dict_path = config_path
         else:
             dict_path = str(config_path).split('.')
-        self._set_to_dict(dict_path, value)
-        self.config_dict_to_text()
+        key = '.'.join(dict_path)
+        if key not in self.store and len(dict_path) > 1 and \
+                not self.store.has_prefix('.'.join(dict_path[:-1])):
+            raise KeyError(key)
+        self._store_value(dict_path, value)
+
+    def apply_template(self, template, variables=None):
+        '''
+        Applies a UbiConfigTemplate to the configuration in one pass.
+
+        Parameters
+        ----------
+        template : UbiquitiManager.UbiConfigTemplate.UbiConfigTemplate
+            Policy to apply.
+        variables : dict, optional
+            Template variables, like the site ones.
+
+        Returns
+        -------
+        changes : dict
+            Key to (old value, new value) of the changed keys.
+        '''
+        changes = template.apply(self.store, variables)
+        if changes:
+            self._config_dict = None
+            self._config_stale = True
+        return changes
 
     def wirless_clients(self):
         '''
@@ -180,36 +465,152 @@ class UbiConfigManager(object):
         )
         return result
 
-    def fw_upgrade(self, fwfile, timeout=(3, 1250)):
+    def _uptime(self, timeout=(3, 10)):
+        '''
+        Returns the uptime reported by status.cgi, with the time it was
+        read, or (None, None) if the device did not give it.
         '''
-        Takes the firmware upgrade file pointed by the given file descriptor.
+        try:
+            status = self.connector.ubi_request_get(
+                'status.cgi',
+                timeout=timeout,
+                use_cache=False,
+                use_breaker=False
+            )
+            return float(status['host']['uptime']), time.time()
+        except Exception:
+            return None, None
+
+    def _rebooted(self, uptime, read_at, deadline):
+        '''
+        Tells if the device restarted since its uptime was read at read_at:
+        its uptime is now shorter than the time elapsed since then (with a
+        second of slack, uptimes are whole seconds).
+        '''
+        elapsed = time.time() - read_at
+        current, _ = self._uptime(_deadline_timeout(deadline, 10))
+        return current is not None and current < uptime + elapsed - 1
+
+    def _wait_reboot(self, flash_timeout, reboot_timeout, uptime=None,
+                     read_at=None):
+        '''
+        Follows the device through its reboot: waits for it to stop
+        accepting connections, or to report an uptime reset by a reboot too
+        quick to be seen down, then for its TCP port and finally for a
+        successful login. Every probe is bounded by the remaining time, and
+        bypasses the circuit breaker. Returns the duration of each step.
+        '''
+        flash_deadline = time.time() + flash_timeout
+
+        def flashed():
+            if not self.connector.ubi_tcp_probe(
+                    timeout=min(1, max(flash_deadline - time.time(), 0.1))):
+                return True
+            return uptime is not None and \
+                self._rebooted(uptime, read_at, flash_deadline)
+
+        try:
+            flash_time = wait_until(
+                flashed,
+                flash_timeout,
+                initial=1,
+                maximum=2
+            )
+        except UbiTimeoutException:
+            raise UbiTimeoutException(
+                'Device did not reboot {}s after flash'.format(flash_timeout)
+            )
+        down_time = time.time()
+        deadline = down_time + reboot_timeout
+        try:
+            reachable_time = wait_until(
+                lambda: self.connector.ubi_tcp_probe(
+                    timeout=_deadline_timeout(deadline)[0]
+                ),
+                reboot_timeout
+            )
+            login_time = wait_until(
+                lambda: self.connector.ubi_authentication(
+                    force=True,
+                    timeout=_deadline_timeout(deadline),
+                    use_breaker=False
+                ) or True,
+                deadline - time.time()
+            )
+        except UbiTimeoutException as excpt:
+            raise UbiAlertConnectivityLost(
+                'Connectivity Lost After Upgrade {}'.format(
+                    str(excpt.last_error or excpt)
+                )
+            )
+        return flash_time, reachable_time, login_time
+
+    def fw_upgrade(self, fwfile, timeout=(3, 1250), flash_timeout=300,
+                   reboot_timeout=400, upload_slot=None, rate_limit=None,
+                   progress=None):
+        '''
+        Takes the firmware upgrade file pointed by the given file descriptor
+        or path. Uploads it, starts the flash and waits for the device to
+        come back after its reboot. The image is streamed, never encoded in
+        memory, and images given by path are mapped once and shared by all
+        the upgrades running in the process.
 
         Parameters
         ----------
-        fwfile : _io.BufferedReader
-            File buffer reader.
+        fwfile : _io.BufferedReader or str or UbiFirmwareImage
+            File buffer reader, or path to the firmware.
         timeout : tuple optional
             specific time outs for firmware upgrade. By default, will wait
             3 seconds for tcp connection, and 1600s for answer (10MB at 64kb/s)
             if you have bandwidth available for sure it can be reasonnable to
             lower these values.
+        flash_timeout : float optional
+            Seconds given to the device to flash and go down for reboot.
+        reboot_timeout : float optional
+            Seconds given to the device, once down, to accept logins again.
+        upload_slot : context manager optional
+            Held only while the image is uploaded, like a semaphore shared
+            by the devices behind the same uplink.
+        rate_limit : float or list optional
+            Upload bytes per second cap, or UbiRateLimiter objects possibly
+            shared with other uploads for a global cap.
+        progress : callable optional
+            Called with (bytes sent, total bytes) during the upload.
+
+        Returns
+        -------
+        result : UbiUpgradeResult
+            Duration of each step of the upgrade.
 
         Raises
         ------
             UbiBadFirmware
                 When file is not a valid Firmware
+            UbiTimeoutException
+                When the device did not reboot after flash.
+            UbiAlertConnectivityLost
+                When the device did not come back after reboot.
         '''
         bad_file = '<div id="error">'
+        if isinstance(fwfile, str):
+            fwfile = UbiFirmwareImage.get(fwfile)
         self.connector.ubi_authentication()
-        result = self.connector.ubi_request_post(
-            'system.cgi',
-            {
-                'fwfile': ('fw.bin', fwfile),
-                'fwupload': 'Restaurer',
-                'action': 'fwupload'
-            },
-            timeout=timeout
-        )
+        upload_start = time.time()
+        with upload_slot or ExitStack():
+            upload_time = time.time()
+            result = self.connector.ubi_request_post(
+                'system.cgi',
+                {
+                    'fwfile': ('fw.bin', fwfile),
+                    'fwupload': 'Restaurer',
+                    'action': 'fwupload'
+                },
+                timeout=timeout,
+                stream=True,
+                rate_limit=rate_limit,
+                progress=progress
+            )
+            upload_time = time.time() - upload_time
         if bad_file in result:
             raise UbiBadFirmware(
                 'Ubiquiti device did not accept this firmware'
@@ -218,18 +619,24 @@ class UbiConfigManager(object):
             raise UbiAuthException(
                 'Ubiquiti disconnected while attemping to push firmware!'
             )
+        uptime, read_at = self._uptime()
         result = self.connector.ubi_request_get(
-            'fwflash.cgi?do_update=do'
+            'fwflash.cgi?do_update=do',
+            retry=False
+        )
+        flash_time, reachable_time, login_time = self._wait_reboot(
+            flash_timeout,
+            reboot_timeout,
+            uptime,
+            read_at
+        )
+        return UbiUpgradeResult(
+            upload_time,
+            flash_time,
+            reachable_time,
+            login_time,
+            time.time() - upload_start
         )
-        for _ in range(0, 20):
-            time.sleep(20)
-            try:
-                self.connector.ubi_authentication()
-                return
-            except Exception as excpt:
-                UbiAlertConnectivityLost(
-                    'Connectivity Lost After Upgrade {}'.format(str(excpt))
-                )
 
     def change_password(self, password, user='admin'):
         '''
@@ -249,19 +656,13 @@ class UbiConfigManager(object):
         UbiConfigChangeFailed
             If the user was no found.
         '''
-        pwd_changed = False
-        for userid, param in self.config_dict['users'].items():
-            print('userid : {}\nparam: {}'.format(userid, param))
-            if not isinstance(param, dict):
-                continue
-            elif 'name' not in param:
-                continue
-            elif param['name'] == user:
+        for key in self.store.match('users.*.name'):
+            if self.store[key] == user:
                 valid_char = string.ascii_letters + string.digits
                 salt = ''.join(random.choice(valid_char) for _ in range(2))
-                param['password'] = crypt(password, salt)
-                pwd_changed = True
-                break
-        if not pwd_changed:
-            raise UbiConfigChangeFailed('User not Found')
-        self.config_dict_to_text()
+                self._store_value(
+                    key.split('.')[:-1] + ['password'],
+                    crypt(password, salt)
+                )
+                return
+        raise UbiConfigChangeFailed('User not Found')
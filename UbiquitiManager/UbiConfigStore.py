@@ -0,0 +1,366 @@
+import re
+import sys
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+from collections import namedtuple
+from collections import OrderedDict
+
+# Key holding the value of a config key which is also the prefix of other
+# keys (radio.1.mode=x and radio.1.mode.y=z). '=' can not be part of a key.
+LEAF_KEY = '='
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(pattern):
+    '''
+    Compiles a key pattern: '*' matches one key segment (no '.') and '**'
+    matches any number of segments. Returns the regex, capturing what
+    each wildcard matched, and the literal prefix found before the first
+    wildcard.
+    '''
+    regex = []
+    for part in re.split(r'(\*\*|\*)', pattern):
+        if part == '**':
+            regex.append('(.*)')
+        elif part == '*':
+            regex.append('([^.]*)')
+        else:
+            regex.append(re.escape(part))
+    return re.compile(''.join(regex) + r'\Z'), pattern.split('*')[0]
+
+
+class UbiConfigDiff(namedtuple('UbiConfigDiff',
+                               ['added', 'removed', 'changed'])):
+    '''
+    Differences between two configurations. added and removed map keys to
+    their value, changed maps keys to (old value, new value). The diff is
+    false when there is no difference.
+    '''
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    __nonzero__ = __bool__
+
+
+class UbiConfigStore(object):
+    '''
+    Flat representation of a device configuration: parallel lists of keys
+    and values in the original line order, plus a sorted key list with the
+    matching line positions for exact, prefix and pattern lookups (built on
+    first lookup). There is no dict per path segment, keys and values are
+    interned so thousands of configs share their strings, and the text is
+    rebuilt byte for byte identical.
+
+    Lines without '=' are kept as they are (value None) but are not keys.
+    When every line break of the text is '\r\n', the '\r' is not part of
+    the values and to_text writes it back.
+
+    Attributes
+    ----------
+    keys : list
+        Keys (or raw lines) in text order.
+    values : list
+        Values matching keys, None for raw lines.
+    newline : str
+        Line separator of the text, '\n' or '\r\n'.
+
+    Methods
+    -------
+    from_text(text)
+        Builds a store from a text config.
+    from_dict(config_dict)
+        Builds a store from a nested config dict, keys sorted.
+    to_text()
+        Returns the text config.
+    to_dict()
+        Returns the nested dict of dict representation.
+    get(key_or_pattern, default=None)
+        Exact lookup, or dict of the keys matching a pattern.
+    subtree(prefix)
+        Iterates on the keys under prefix.
+    set(key, value)
+        Changes or appends a key.
+    remove(key)
+        Removes a key.
+    diff(other)
+        Returns the UbiConfigDiff to go from this config to other.
+    '''
+    def __init__(self):
+        self.keys = []
+        self.values = []
+        self.newline = '\n'
+        self._sorted = None
+        self._positions = None
+
+    @classmethod
+    def from_text(cls, text):
+        '''
+        Builds a store from a text config, one key=value per line.
+        '''
+        store = cls()
+        if text is None:
+            return store
+        intern = sys.intern
+        keys = store.keys
+        values = store.values
+        text = str(text)
+        newline_count = text.count('\n')
+        if newline_count and text.count('\r\n') == newline_count:
+            store.newline = '\r\n'
+        for line in text.split(store.newline):
+            key, separator, value = line.partition('=')
+            if not separator:
+                keys.append(line)
+                values.append(None)
+                continue
+            keys.append(intern(key))
+            values.append(intern(value))
+        return store
+
+    @classmethod
+    def from_dict(cls, config_dict):
+        '''
+        Builds a store from a nested config dict, keys sorted like the
+        device does.
+        '''
+        def flatten(thisdict, path=''):
+            for nextpath, val in thisdict.items():
+                if nextpath == LEAF_KEY:
+                    yield path[:-1], val
+                elif isinstance(val, dict):
+                    for item in flatten(val, path + nextpath + '.'):
+                        yield item
+                else:
+                    yield path + nextpath, val
+        store = cls()
+        for key, value in sorted(flatten(config_dict)):
+            store.set(key, value)
+        return store
+
+    def copy(self):
+        '''
+        Returns an independent copy sharing the interned strings.
+        '''
+        store = UbiConfigStore()
+        store.keys = list(self.keys)
+        store.values = list(self.values)
+        store.newline = self.newline
+        if self._sorted is not None:
+            store._sorted = list(self._sorted)
+            store._positions = array('l', self._positions)
+        return store
+
+    def _sorted_index(self):
+        '''
+        Returns the sorted keys and their line positions. When a key is
+        present twice the last line wins, like when the device parses it.
+        '''
+        if self._sorted is None:
+            pairs = sorted(
+                (key, position) for position, key in enumerate(self.keys)
+                if self.values[position] is not None
+            )
+            sorted_keys = []
+            positions = array('l')
+            for key, position in pairs:
+                if sorted_keys and sorted_keys[-1] == key:
+                    positions[-1] = position
+                    continue
+                sorted_keys.append(key)
+                positions.append(position)
+            self._sorted = sorted_keys
+            self._positions = positions
+        return self._sorted, self._positions
+
+    def _position(self, key):
+        sorted_keys, positions = self._sorted_index()
+        found = bisect_left(sorted_keys, key)
+        if found < len(sorted_keys) and sorted_keys[found] == key:
+            return positions[found]
+        return None
+
+    def __len__(self):
+        return len(self._sorted_index()[0])
+
+    def __contains__(self, key):
+        return self._position(key) is not None
+
+    def __getitem__(self, key):
+        position = self._position(key)
+        if position is None:
+            raise KeyError(key)
+        return self.values[position]
+
+    def __iter__(self):
+        return (
+            key for position, key in enumerate(self.keys)
+            if self.values[position] is not None
+        )
+
+    def items(self):
+        '''
+        Iterates on (key, value) in text order.
+        '''
+        return (
+            (key, value) for key, value in zip(self.keys, self.values)
+            if value is not None
+        )
+
+    def to_text(self):
+        '''
+        Returns the text config, identical to the parsed one plus edits.
+        '''
+        return self.newline.join(
+            key if value is None else '{}={}'.format(key, value)
+            for key, value in zip(self.keys, self.values)
+        )
+
+    def to_dict(self):
+        '''
+        Returns the nested dict of dict representation. When a key is also
+        the prefix of other keys, its value is stored under LEAF_KEY.
+        '''
+        config_dict = {}
+        for key, value in self.items():
+            path = key.split('.')
+            node = config_dict
+            for element in path[:-1]:
+                child = node.get(element)
+                if child is None:
+                    child = node[element] = {}
+                elif not isinstance(child, dict):
+                    child = node[element] = {LEAF_KEY: child}
+                node = child
+            if isinstance(node.get(path[-1]), dict):
+                node[path[-1]][LEAF_KEY] = value
+            else:
+                node[path[-1]] = value
+        return config_dict
+
+    def _prefixed(self, prefix):
+        sorted_keys = self._sorted_index()[0]
+        position = bisect_left(sorted_keys, prefix)
+        while position < len(sorted_keys) and \
+                sorted_keys[position].startswith(prefix):
+            yield sorted_keys[position]
+            position += 1
+
+    def has_prefix(self, prefix):
+        '''
+        True if a key is under prefix (prefix.something).
+        '''
+        for _ in self._prefixed(prefix + '.'):
+            return True
+        return False
+
+    def subtree(self, prefix):
+        '''
+        Iterates on (key, value) for prefix itself and the keys under it,
+        in sorted key order.
+        '''
+        if prefix in self:
+            yield prefix, self[prefix]
+        for key in self._prefixed(prefix + '.'):
+            yield key, self[key]
+
+    def match(self, pattern):
+        '''
+        Returns the keys matching pattern, '*' matching one key segment and
+        '**' any number of segments, in text order.
+        '''
+        regex, prefix = compile_pattern(pattern)
+        matched = [
+            (self._position(key), key) for key in self._prefixed(prefix)
+            if regex.match(key)
+        ]
+        return [key for _, key in sorted(matched)]
+
+    def get(self, key, default=None):
+        '''
+        Returns the value of key or default. If key contains '*' returns an
+        OrderedDict of the matching keys and their values instead.
+        '''
+        if '*' in key:
+            return OrderedDict((k, self[k]) for k in self.match(key))
+        position = self._position(key)
+        if position is None:
+            return default
+        return self.values[position]
+
+    def set(self, key, value):
+        '''
+        Changes the value of key, or appends it at the end if missing
+        (before the final newline of the text, if any).
+        '''
+        value = sys.intern(str(value))
+        position = self._position(key)
+        if position is not None:
+            self.values[position] = value
+            return
+        key = sys.intern(str(key))
+        position = len(self.keys)
+        if position and self.keys[-1] == '' and self.values[-1] is None:
+            position -= 1
+        self.keys.insert(position, key)
+        self.values.insert(position, value)
+        found = bisect_left(self._sorted, key)
+        self._sorted.insert(found, key)
+        self._positions.insert(found, position)
+
+    def remove(self, key):
+        '''
+        Removes key from the store.
+
+        Raises
+        ------
+        KeyError
+            If the key is missing.
+        '''
+        position = self._position(key)
+        if position is None:
+            raise KeyError(key)
+        del self.keys[position]
+        del self.values[position]
+        self._sorted = None
+        self._positions = None
+
+    def diff(self, other):
+        '''
+        Compares with another configuration in one walk over both sorted
+        key lists.
+
+        Parameters
+        ----------
+        other : UbiConfigStore
+            Wanted configuration.
+
+        Returns
+        -------
+        diff : UbiConfigDiff
+            Keys to add, remove and change to go from self to other.
+        '''
+        added = OrderedDict()
+        removed = OrderedDict()
+        changed = OrderedDict()
+        old_keys, old_positions = self._sorted_index()
+        new_keys, new_positions = other._sorted_index()
+        old, new = 0, 0
+        while old < len(old_keys) or new < len(new_keys):
+            if new >= len(new_keys) or \
+                    (old < len(old_keys) and old_keys[old] < new_keys[new]):
+                removed[old_keys[old]] = self.values[old_positions[old]]
+                old += 1
+            elif old >= len(old_keys) or old_keys[old] > new_keys[new]:
+                added[new_keys[new]] = other.values[new_positions[new]]
+                new += 1
+            else:
+                old_value = self.values[old_positions[old]]
+                new_value = other.values[new_positions[new]]
+                if old_value != new_value:
+                    changed[old_keys[old]] = (old_value, new_value)
+                old += 1
+                new += 1
+        return UbiConfigDiff(added, removed, changed)
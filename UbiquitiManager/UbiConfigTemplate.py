@@ -0,0 +1,186 @@
+from string import Template
+from collections import namedtuple
+from UbiquitiManager.UbiConfigStore import compile_pattern
+from UbiquitiManager.UbiConfigStore import UbiConfigStore
+
+_Rule = namedtuple('_Rule', ['pattern', 'regex', 'prefix', 'value', 'when'])
+
+
+class UbiConfigTemplate(object):
+    '''
+    Declarative configuration policy, compiled once and applied to many
+    configurations. Each rule sets the keys matching a pattern to a value
+    rendered with string.Template, optionally only when conditions on the
+    current values hold.
+
+    A rule is a dict with:
+
+    - key: key pattern, '*' matching one key segment and '**' any number
+      of segments (see UbiConfigStore.match). Patterns only change existing
+      keys, a key without wildcard is created if missing (when its parent
+      prefix exists, like UbiConfigManager.set_value, otherwise skipped).
+    - value: template of the value. Besides the variables given to apply,
+      $key is the matched key, $value its current value and $w1, $w2...
+      what each wildcard matched.
+    - when (optional): dict of key template to the wanted value, or list of
+      accepted values, None meaning the key must be missing. For instance
+      {'radio.$w1.mode': 'master'}.
+
+    All rules are evaluated against the configuration as it was before the
+    template was applied, a later rule wins when two rules set the same key.
+
+    Attributes
+    ----------
+    rules : list
+        Rules as given.
+    defaults : dict
+        Variables used when not given to apply.
+
+    Methods
+    -------
+    render(store, variables=None)
+        Returns the changes the template makes to a configuration.
+    apply(target, variables=None)
+        Applies the template to a UbiConfigStore or UbiConfigManager.
+    apply_many(targets, variables=None)
+        Applies the template to many configurations.
+    '''
+    def __init__(self, rules, **defaults):
+        if isinstance(rules, dict):
+            rules = [{'key': key, 'value': value}
+                     for key, value in rules.items()]
+        self.rules = list(rules)
+        self.defaults = defaults
+        self._compiled = []
+        for rule in self.rules:
+            regex, prefix = compile_pattern(rule['key'])
+            when = []
+            for key, accepted in (rule.get('when') or {}).items():
+                if accepted is not None and \
+                        not isinstance(accepted, (list, tuple, set)):
+                    accepted = [accepted]
+                if accepted is not None:
+                    accepted = set(str(value) for value in accepted)
+                when.append((Template(key), accepted))
+            self._compiled.append(_Rule(
+                rule['key'],
+                regex,
+                prefix,
+                Template(str(rule['value'])),
+                when
+            ))
+
+    @staticmethod
+    def _holds(store, when, variables):
+        for key, accepted in when:
+            value = store.get(key.substitute(variables))
+            if accepted is None:
+                if value is not None:
+                    return False
+            elif value not in accepted:
+                return False
+        return True
+
+    def _targets(self, store, rule):
+        if rule.prefix == rule.pattern:
+            key = rule.pattern
+            parent = key.rpartition('.')[0]
+            if key in store or not parent or store.has_prefix(parent):
+                yield key, ()
+            return
+        for key in store.match(rule.pattern):
+            yield key, rule.regex.match(key).groups()
+
+    def render(self, store, variables=None):
+        '''
+        Computes the changes the template makes to a configuration, without
+        applying them.
+
+        Parameters
+        ----------
+        store : UbiConfigStore
+            Configuration to evaluate.
+        variables : dict, optional
+            Template variables, like the site ones, added to the defaults.
+
+        Returns
+        -------
+        changes : dict
+            Key to (current value, new value) for the keys to change, the
+            current value being None for keys to create.
+
+        Raises
+        ------
+        KeyError
+            If a template uses a variable which is not given.
+        '''
+        base = dict(self.defaults)
+        base.update(variables or {})
+        wanted = {}
+        for rule in self._compiled:
+            for key, groups in self._targets(store, rule):
+                current = store.get(key)
+                rule_variables = dict(base)
+                rule_variables.update(
+                    ('w{}'.format(index), group)
+                    for index, group in enumerate(groups, 1)
+                )
+                rule_variables['key'] = key
+                rule_variables['value'] = '' if current is None else current
+                if not self._holds(store, rule.when, rule_variables):
+                    continue
+                wanted[key] = (current, rule.value.substitute(rule_variables))
+        return {
+            key: values for key, values in wanted.items()
+            if values[0] != values[1]
+        }
+
+    def apply(self, target, variables=None):
+        '''
+        Applies the template to a configuration.
+
+        Parameters
+        ----------
+        target : UbiConfigStore or UbiConfigManager
+            Configuration to change, see UbiConfigManager.apply_template
+            for managers.
+        variables : dict, optional
+            Template variables, added to the defaults.
+
+        Returns
+        -------
+        changes : dict
+            Key to (old value, new value) of the changed keys, see render.
+        '''
+        if not isinstance(target, UbiConfigStore):
+            return target.apply_template(self, variables)
+        changes = self.render(target, variables)
+        for key, values in changes.items():
+            target.set(key, values[1])
+        return changes
+
+    def apply_many(self, targets, variables=None):
+        '''
+        Applies the template to many configurations.
+
+        Parameters
+        ----------
+        targets : dict
+            Name (like the host) to UbiConfigStore or UbiConfigManager.
+        variables : dict or callable, optional
+            Name to its variables (like the variables of its site), or
+            function returning the variables of a name.
+
+        Returns
+        -------
+        changes : dict
+            Name to the changes made to its configuration, see render.
+        '''
+        results = {}
+        for name, target in targets.items():
+            if callable(variables):
+                target_variables = variables(name)
+            else:
+                target_variables = (variables or {}).get(name)
+            results[name] = self.apply(target, target_variables)
+        return results
@@ -1,12 +1,25 @@
+import time
 import socket
 import requests
+from contextlib import ExitStack
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
 from UbiquitiManager.UbiExceptions import UbiHttpException
 from UbiquitiManager.UbiExceptions import UbiAuthException
-from UbiquitiManager.UbiExceptions import UbiHostException
+from UbiquitiManager.UbiExceptions import UbiCircuitOpen
+from UbiquitiManager.UbiResolver import DEFAULT_RESOLVER
+from UbiquitiManager.UbiJson import decode
+from UbiquitiManager.UbiCredentialCache import DEFAULT_CREDENTIAL_CACHE
+from UbiquitiManager.UbiUpload import UbiRateLimiter
+from UbiquitiManager.UbiUpload import UbiFirmwareImage
+from UbiquitiManager.UbiUpload import UbiMultipartEncoder
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+LOGIN_PAGE_MARKER = 'class="logintable"'
+# Connect and read time outs of the login.cgi requests.
+LOGIN_TIMEOUT = (3, 30)
+
 
 class UbiConnector(object):
     '''
@@ -17,7 +30,14 @@ class UbiConnector(object):
     Attributes
     ----------
     host : str
-        host targeted for data gathering
+        Address of the host targeted for data gathering. Resolved at
+        creation, or on first use with lazy_resolve.
+    hostname : str
+        host as given at creation.
+    name : str
+        hostname, followed by ':port' when the port is not 80 or 443.
+    resolver : UbiquitiManager.UbiResolver.UbiResolver
+        Resolver (with its cache) used to find the address.
     login : str
         Login crediential to access the target.
     passwords : list
@@ -30,31 +50,67 @@ class UbiConnector(object):
     baseurl : str
         url validated after authentication.
     data : dict
-        for every page requested will store latest gathered data.
+        for every page requested will store latest gathered data, unless
+        retain_data is False.
+    retain_data : bool
+        Keep the JSON results in data. Long running pollers, which pass
+        the results on, can disable it.
+    session : requests.Session
+        Authenticated session, kept and reused until the device expires it.
+    credential_cache : UbiquitiManager.UbiCredentialCache.UbiCredentialCache
+        Remembers which password worked for the host, tried first on login.
+    response_cache : UbiquitiManager.UbiResponseCache.UbiResponseCache
+        Optional cache of GET results, None to always query the device.
+    stats : dict
+        Session counters: ``logins`` performed, ``logins_avoided`` because
+        the session was still valid, ``session_expired`` when the device
+        answered with its login page and a new login was needed,
+        ``login_attempts`` counting every password posted to login.cgi,
+        ``retries`` of requests sent again and ``circuit_open`` requests
+        refused by the breaker.
+    metrics : UbiquitiManager.UbiMetrics.UbiMetrics
+        Optional recorder of request latencies, bytes, logins, parse
+        failures and errors, usually shared by many connectors.
+    transport : UbiquitiManager.UbiTransport.UbiTransport
+        Optional connection pools shared with the other connectors, also
+        capping the requests in flight to the device.
+    retry : UbiquitiManager.UbiRetry.UbiRetryPolicy
+        Optional policy sending GET requests again after connection
+        errors or 5xx answers.
+    breaker : UbiquitiManager.UbiRetry.UbiCircuitBreaker
+        Optional circuit breaker, usually shared by many connectors,
+        failing fast for devices which recently did not answer.
 
     Methods
     -------
-    ubi_authentication()
+    ubi_authentication(force=False, timeout=LOGIN_TIMEOUT, use_breaker=True)
         Attemps authentication to the device, Raise exception if failed to log
-        in.
+        in. Does nothing if a session is already opened unless forced.
     ubi_request_post(path, data)
         Attemps to gather data via post to the given path, setting encoding
         type to multipart/form-data.
-    ubi_request_get(path)
-        Attemps to gather data via get to the given path.
+    ubi_request_get(path, use_cache=True, use_breaker=True, retry=True)
+        Attemps to gather data via get to the given path, answered from
+        response_cache when a valid result is there.
     ubi_add_password(other_password)
         Extend the possible passwords list.
+    ubi_tcp_probe(timeout=3)
+        Checks if the device accepts TCP connections.
     '''
 
     # pylint: disable=too-many-instance-attributes
     # pylint: disable=too-many-arguments
 
-    def __init__(self, host, login, password, protocol='https', port=443):
-        self.host = None
-        try:
-            self.host = socket.gethostbyname(str(host))
-        except socket.gaierror:
-            raise UbiHostException('enable to resolve given host')
+    def __init__(self, host, login, password, protocol='https', port=443,
+                 credential_cache=None, response_cache=None, address=None,
+                 lazy_resolve=False, resolver=None, metrics=None,
+                 retain_data=True, transport=None, retry=None,
+                 breaker=None):
+        self.hostname = str(host)
+        self.resolver = resolver or DEFAULT_RESOLVER
+        self._address = address
+        if not address and not lazy_resolve:
+            self._address = self.resolver.resolve(self.hostname)
 
         self.login = str(login)
         if isinstance(password, list):
@@ -65,44 +121,178 @@ class UbiConnector(object):
         self.port = str(port)
         self.baseurl = None
         self.data = {}
+        self.retain_data = retain_data
+        self.transport = transport
+        self.retry = retry
+        self.breaker = breaker
         self.session = None
+        self.credential_cache = credential_cache
+        if credential_cache is None:
+            self.credential_cache = DEFAULT_CREDENTIAL_CACHE
+        self.response_cache = response_cache
+        self.metrics = metrics
+        self._metrics_host = self.hostname
+        if self.port not in ('80', '443'):
+            self._metrics_host = '{}:{}'.format(self.hostname, self.port)
+        self.stats = {
+            'logins': 0,
+            'logins_avoided': 0,
+            'session_expired': 0,
+            'login_attempts': 0,
+            'retries': 0,
+            'circuit_open': 0,
+        }
+
+    @property
+    def name(self):
+        '''
+        Name of the device in metrics, breaker and results: hostname,
+        followed by ':port' when the port is not 80 or 443, so devices
+        sharing an address are told apart.
+        '''
+        return self._metrics_host
+
+    @property
+    def host(self):
+        '''
+        Address of the device, resolved on first use if it was not at
+        creation.
+
+        Raises
+        ------
+        UbiHostException
+            If the host can not be resolved.
+        '''
+        if not self._address:
+            self._address = self.resolver.resolve(self.hostname)
+        return self._address
 
-    def ubi_authentication(self):
+    @host.setter
+    def host(self, address):
+        self._address = address
+
+    @staticmethod
+    def _is_login_page(text):
+        if 'logintable' not in text:
+            return False
+        clean_data = text.replace(' ', '')
+        clean_data = clean_data.replace('\t', '')
+        return LOGIN_PAGE_MARKER in clean_data
+
+    def _session_expired(self, result):
+        '''
+        The device answers any page with its login form (usually after a
+        redirect to login.cgi) once the session cookie is no longer valid.
+        '''
+        if '/login.cgi' in result.url:
+            return True
+        if b'logintable' not in result.content:
+            return False
+        return self._is_login_page(result.text)
+
+    def ubi_authentication(self, force=False, timeout=LOGIN_TIMEOUT,
+                           use_breaker=True):
         '''
         Attemps authentication to the device, Raise exception if failed to log
-        in.
+        in. The authenticated session is kept, so calling it again is free
+        until the device expires the session (detected on the next request)
+        or until force is used. The password known to work for the host is
+        tried first, and the one that works is recorded in credential_cache.
+
+        Parameters
+        ----------
+        force : bool, optional
+            Log in again even if a session is already opened.
+        timeout : tuple, optional
+            Time outs of each login.cgi request.
+        use_breaker : bool, optional
+            False to log in even if the breaker refuses the device, without
+            recording the outcome, when an outage is expected.
 
         Raises
         ------
         UbiAuthException
             if none of the login:pawwsords worked.
+        UbiCircuitOpen
+            if the breaker refused the login, the device failed recently.
         '''
-        session = requests.session()
-        session.verify = False
-        session.get(
-            '{0}://{1}:{2}/login.cgi'.format(
-                self.protocol,
-                self.host,
-                self.port
-            )
-        )
-        for password in self.passwords:
-            data = session.post(
+        if self.session is not None and not force:
+            self.stats['logins_avoided'] += 1
+            return
+        breaker = self.breaker if use_breaker else None
+        if breaker is not None:
+            self._check_breaker('login.cgi')
+        try:
+            self._authenticate(timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if breaker is not None:
+                breaker.failure(self._metrics_host)
+            raise
+        except UbiAuthException:
+            if breaker is not None:
+                breaker.success(self._metrics_host)
+            raise
+        if breaker is not None:
+            breaker.success(self._metrics_host)
+
+    def _authenticate(self, timeout):
+        '''
+        Logs in, in a new session unless one is kept.
+        '''
+        self.stats['logins'] += 1
+        start = time.perf_counter()
+        session = self.session
+        if session is None:
+            session = requests.session()
+            session.verify = False
+            if self.transport is not None:
+                self.transport.mount(
+                    session,
+                    self.protocol,
+                    self.host,
+                    self.port
+                )
+        try:
+            self._login(session, start, timeout)
+        except requests.RequestException as excpt:
+            if self.metrics is not None:
+                self.metrics.error(self._metrics_host, 'login.cgi', excpt)
+            raise
+
+    def _login(self, session, start, timeout):
+        '''
+        Posts the passwords to login.cgi until one works.
+        '''
+        attempts = 0
+        with self._slot():
+            session.get(
                 '{0}://{1}:{2}/login.cgi'.format(
                     self.protocol,
                     self.host,
                     self.port
                 ),
-                files={
-                    'username': (None, self.login),
-                    'password': (None, password),
-                    'uri': (None, '')
-                },
+                timeout=timeout,
                 verify=False
             )
-            clean_data = data.text.replace(' ', '')
-            clean_data = clean_data.replace('\t', '')
-            if 'class="logintable"' not in clean_data:
+        for password in self.credential_cache.order(self.host, self.passwords):
+            self.stats['login_attempts'] += 1
+            attempts += 1
+            with self._slot():
+                data = session.post(
+                    '{0}://{1}:{2}/login.cgi'.format(
+                        self.protocol,
+                        self.host,
+                        self.port
+                    ),
+                    files={
+                        'username': (None, self.login),
+                        'password': (None, password),
+                        'uri': (None, '')
+                    },
+                    timeout=timeout,
+                    verify=False
+                )
+            if not self._is_login_page(data.text):
                 base_url = '{0}://{1}:{2}'.format(
                     self.protocol,
                     self.host,
@@ -110,23 +300,205 @@ class UbiConnector(object):
                 )
                 self.baseurl = base_url
                 self.session = session
+                self.credential_cache.set(self.host, password)
+                if self.metrics is not None:
+                    self.metrics.login(
+                        self._metrics_host,
+                        attempts,
+                        True,
+                        time.perf_counter() - start
+                    )
                 return
-        raise UbiAuthException('Authentication Failed')
+        self.credential_cache.forget(self.host)
+        self.session = None
+        self.baseurl = None
+        excpt = UbiAuthException('Authentication Failed')
+        if self.metrics is not None:
+            self.metrics.login(
+                self._metrics_host,
+                attempts,
+                False,
+                time.perf_counter() - start
+            )
+            self.metrics.error(self._metrics_host, 'login.cgi', excpt)
+        raise excpt
+
+    def _check_breaker(self, path):
+        '''
+        Raises UbiCircuitOpen if the breaker refuses the device.
+        '''
+        try:
+            self.breaker.check(self._metrics_host)
+        except UbiCircuitOpen as excpt:
+            self.stats['circuit_open'] += 1
+            if self.metrics is not None:
+                self.metrics.error(self._metrics_host, path, excpt)
+            raise
+
+    @staticmethod
+    def _connect_failed(excpt):
+        '''
+        Tells if a requests exception happened before the connection was
+        opened (refused, unreachable, connect time out), the request was
+        then never sent.
+        '''
+        if isinstance(excpt, requests.ConnectTimeout):
+            return True
+        reason = getattr(excpt.args[0] if excpt.args else None, 'reason',
+                         None)
+        # NewConnectionError is a ConnectTimeoutError.
+        return isinstance(reason, ConnectTimeoutError)
+
+    def _send(self, method, path, timeout, files=None, body=None,
+              use_breaker=True, use_retry=True):
+        '''
+        Sends the request, refused by the circuit breaker if the device
+        recently failed (unless use_breaker is False), and sent again as the
+        retry policy allows (unless use_retry is False).
+        '''
+        breaker = self.breaker if use_breaker else None
+        delays = []
+        if self.retry is not None and use_retry:
+            delays = self.retry.delays()
+        while True:
+            if breaker is not None:
+                self._check_breaker(path)
+            try:
+                result = self._exchange(method, path, timeout, files, body)
+            except (requests.ConnectionError, requests.Timeout) as excpt:
+                if breaker is not None:
+                    breaker.failure(self._metrics_host)
+                    if breaker.state(self._metrics_host) != 'closed':
+                        raise
+                # Once sent (read time out, connection aborted) the device
+                # may have acted on the request, only failures to connect
+                # are retried.
+                if not delays or not self._connect_failed(excpt) or \
+                        not self.retry.retry_error(method):
+                    raise
+            else:
+                if breaker is not None:
+                    breaker.success(self._metrics_host)
+                if not delays or not self.retry.retry_status(
+                        method, result.status_code):
+                    return result
+            self.stats['retries'] += 1
+            time.sleep(delays.pop(0))
+
+    def _exchange(self, method, path, timeout, files=None, body=None):
+        '''
+        Sends the request over the kept session, logging in first if needed.
+        If the device answers with its login page the session is renewed once
+        and the request is sent again. body is an UbiMultipartEncoder.
+        '''
+        login_timeout = self._login_timeout(timeout)
+        if self.session is None:
+            self._authenticate(login_timeout)
+        positions = {}
+        for key, value in (files or {}).items():
+            if hasattr(value[1], 'seek'):
+                positions[key] = value[1].tell()
+        result = self._request(method, path, timeout, files, body)
+        if self._session_expired(result):
+            self.stats['session_expired'] += 1
+            self._authenticate(login_timeout)
+            for key, position in positions.items():
+                files[key][1].seek(position)
+            if body is not None:
+                body.rewind()
+            result = self._request(method, path, timeout, files, body)
+        return result
+
+    @staticmethod
+    def _login_timeout(timeout):
+        '''
+        Time outs of a login made for a request: those of the request, when
+        shorter than LOGIN_TIMEOUT.
+        '''
+        if timeout is None:
+            return LOGIN_TIMEOUT
+        if not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        return tuple(
+            min(request, login)
+            for request, login in zip(timeout, LOGIN_TIMEOUT)
+        )
+
+    def _slot(self):
+        '''
+        Request slot of the device in the transport, if any.
+        '''
+        if self.transport is None:
+            return ExitStack()
+        return self.transport.slot(self.protocol, self.host, self.port)
+
+    def _request(self, method, path, timeout, files, body):
+        '''
+        One HTTP exchange over the session, recorded in metrics if set.
+        '''
+        headers = None
+        if body is not None:
+            headers = {'Content-Type': body.content_type}
+        with self._slot():
+            start = time.perf_counter()
+            try:
+                result = self.session.request(
+                    method,
+                    '{}/{}'.format(self.baseurl, path),
+                    files=files,
+                    data=body,
+                    headers=headers,
+                    timeout=timeout,
+                    verify=False
+                )
+            except requests.RequestException as excpt:
+                if self.metrics is not None:
+                    self.metrics.error(self._metrics_host, path, excpt)
+                raise
+        if self.metrics is not None:
+            sent = 0
+            if body is not None:
+                sent = len(body)
+            elif result.request.body is not None:
+                sent = len(result.request.body)
+            self.metrics.request(
+                self._metrics_host,
+                path,
+                method,
+                result.status_code,
+                time.perf_counter() - start,
+                sent,
+                len(result.content)
+            )
+        return result
 
     def _treat_http_return(self, result, path):
         if result.status_code < 200 or result.status_code > 299:
-            raise UbiHttpException(
+            excpt = UbiHttpException(
                 'Http server returned Code {}'.format(
                     result.status_code
                 )
             )
+            if self.metrics is not None:
+                self.metrics.error(self._metrics_host, path, excpt)
+            raise excpt
         try:
-            self.data[path] = result.json()
-            return self.data[path]
-        except:
+            is_json, data = decode(
+                result.headers.get('Content-Type'),
+                result.content
+            )
+        except ValueError:
+            if self.metrics is not None:
+                self.metrics.parse_failure(self._metrics_host, path)
             return result.text
+        if not is_json:
+            return result.text
+        if self.retain_data:
+            self.data[path] = data
+        return data
 
-    def ubi_request_post(self, path, data, timeout=(3, 250)):
+    def ubi_request_post(self, path, data, timeout=(3, 250), stream=False,
+                         rate_limit=None, progress=None):
         '''
         Attemps to gather data via post to the given path, setting encoding
         type to multipart/form-data.
@@ -142,6 +514,14 @@ class UbiConnector(object):
         timeout : tuple optional
             Time outs for genereal purpose requests. By default, will wait
             3 seconds for tcp connection, and 250s for answer.
+        stream : bool optional
+            Encode the body while sending it instead of building it in
+            memory. Always done when a value is an UbiFirmwareImage.
+        rate_limit : float or list optional
+            Bytes per second cap of a streamed body, or UbiRateLimiter
+            objects (possibly shared with other uploads) to go through.
+        progress : callable optional
+            Called with (bytes sent, total bytes) while streaming.
 
         Returns
         -------
@@ -153,34 +533,60 @@ class UbiConnector(object):
         ------
         UbiHttpException
             if http return code was not of type 2xx.
+        UbiCircuitOpen
+            if the breaker refused the request, the device failed recently.
         '''
         for key in data:
             if not isinstance(data[key], tuple):
                 data[key] = (None, data[key])
 
-        result = self.session.post(
-            '{}/{}'.format(self.baseurl, path),
-            files=data,
-            timeout=timeout
-        )
+        if stream or any(
+                isinstance(value[1], UbiFirmwareImage)
+                for value in data.values()):
+            if not isinstance(rate_limit, (list, tuple)):
+                rate_limit = [rate_limit]
+            body = UbiMultipartEncoder(
+                data,
+                limiters=[
+                    limiter if isinstance(limiter, UbiRateLimiter)
+                    else UbiRateLimiter(limiter)
+                    for limiter in rate_limit if limiter
+                ],
+                progress=progress
+            )
+            result = self._send('POST', path, timeout, body=body)
+        else:
+            result = self._send('POST', path, timeout, files=data)
+        if self.response_cache is not None:
+            self.response_cache.invalidate((self.host, self.port))
         result = self._treat_http_return(result, path)
         return result
 
-    def ubi_request_get(self, path, timeout=(3, 250)):
+    def ubi_request_get(self, path, timeout=(3, 250), use_cache=True,
+                        use_breaker=True, retry=True):
         '''
-        Attemps to gather data via post to the given path, setting encoding
-        type to multipart/form-data.
+        Attemps to gather data via get to the given path. When a
+        response_cache is set and holds a valid result for the path, it is
+        returned without querying the device. Any POST empties the cache of
+        the device.
 
         Parameters
         ----------
         path : str
             path to add to the base connection url.
-        data : dict
-            parameter to post to the given path. With key=form_id and and
-            value=form_value
         timeout : tuple optional
             Time outs for genereal purpose requests. By default, will wait
             3 seconds for tcp connection, and 250s for answer.
+        use_cache : bool optional
+            False to bypass the response cache (the fresh result is still
+            stored in it).
+        use_breaker : bool optional
+            False to send the request even if the breaker refuses the
+            device, without recording the outcome, for probes of a device
+            expected to be down for a while.
+        retry : bool optional
+            False to never send the request again, for GETs which are not
+            idempotent (like fwflash.cgi starting the flash).
 
         Returns
         -------
@@ -192,12 +598,25 @@ class UbiConnector(object):
         ------
         UbiHttpException
             if http return code was not of type 2xx.
+        UbiCircuitOpen
+            if the breaker refused the request, the device failed recently.
         '''
-        result = self.session.get(
-            '{}/{}'.format(self.baseurl, path),
-            timeout=timeout
+        cache = self.response_cache
+        if cache is not None and use_cache:
+            hit, result = cache.get((self.host, self.port), path)
+            if hit:
+                return result
+        result = self._send(
+            'GET',
+            path,
+            timeout,
+            use_breaker=use_breaker,
+            use_retry=retry
         )
-        return self._treat_http_return(result, path)
+        result = self._treat_http_return(result, path)
+        if cache is not None:
+            cache.put((self.host, self.port), path, result)
+        return result
 
     def ubi_add_password(self, other_password):
         '''
@@ -214,6 +633,31 @@ class UbiConnector(object):
         else:
             self.passwords.append(str(other_password))
 
+    def ubi_tcp_probe(self, timeout=3):
+        '''
+        Cheap reachability check, opens and closes a TCP connection to the
+        device port without any HTTP exchange.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait for the connection.
+
+        Returns
+        -------
+        reachable : bool
+            True if the device accepted the connection.
+        '''
+        try:
+            probe = socket.create_connection(
+                (self.host, int(self.port)),
+                timeout=timeout
+            )
+        except (socket.error, socket.timeout):
+            return False
+        probe.close()
+        return True
+
 
 if __name__ == '__main__':
     AP = UbiConnector(
@@ -0,0 +1,167 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+
+
+class UbiCredentialCache(object):
+    '''
+    In memory cache remembering which password last worked for a host, so
+    authentication tries it first instead of walking the whole password
+    list. Passwords are never stored, only a digest salted with the host.
+
+    Methods
+    -------
+    get(host)
+        Returns the stored hint for the host or None.
+    set(host, password)
+        Records the password as the known good one for the host.
+    forget(host)
+        Drops the hint for the host.
+    order(host, passwords)
+        Returns passwords with the known good one first.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hints = {}
+
+    @staticmethod
+    def digest(host, password):
+        '''
+        Returns the hint stored for a host/password couple.
+        '''
+        return hashlib.sha256(
+            '{}\x00{}'.format(host, password).encode('utf-8')
+        ).hexdigest()
+
+    def _load(self, host):
+        return self._hints.get(host)
+
+    def _store(self, host, hint):
+        self._hints[host] = hint
+
+    def _delete(self, host):
+        self._hints.pop(host, None)
+
+    def get(self, host):
+        '''
+        Returns the stored hint for the host or None.
+        '''
+        with self._lock:
+            return self._load(str(host))
+
+    def set(self, host, password):
+        '''
+        Records the password as the known good one for the host.
+
+        Parameters
+        ----------
+        host : str
+            Resolved host the password was valid for.
+        password : str
+            Password that successfully logged in.
+        '''
+        hint = self.digest(host, password)
+        with self._lock:
+            if self._load(str(host)) != hint:
+                self._store(str(host), hint)
+
+    def forget(self, host):
+        '''
+        Drops the hint for the host.
+        '''
+        with self._lock:
+            self._delete(str(host))
+
+    def order(self, host, passwords):
+        '''
+        Returns a copy of passwords with the known good one first.
+
+        Parameters
+        ----------
+        host : str
+            Resolved host.
+        passwords : list
+            Candidate passwords, in the preferred order.
+        '''
+        hint = self.get(host)
+        if hint is None:
+            return list(passwords)
+        known = [p for p in passwords if self.digest(host, p) == hint]
+        return known + [p for p in passwords if p not in known]
+
+
+class UbiJsonCredentialCache(UbiCredentialCache):
+    '''
+    Credential hint cache persisted in a JSON file, so hints survive from
+    one fleet sweep to the next. The file is rewritten on each change.
+
+    Attributes
+    ----------
+    path : str
+        Path to the JSON file.
+    '''
+    def __init__(self, path):
+        super(UbiJsonCredentialCache, self).__init__()
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as hints_file:
+                self._hints = json.load(hints_file)
+
+    def _flush(self):
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as hints_file:
+            json.dump(self._hints, hints_file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def _store(self, host, hint):
+        self._hints[host] = hint
+        self._flush()
+
+    def _delete(self, host):
+        if self._hints.pop(host, None) is not None:
+            self._flush()
+
+
+class UbiSqliteCredentialCache(UbiCredentialCache):
+    '''
+    Credential hint cache persisted in a SQLite database, better suited
+    than JSON when several processes share it or the fleet is large.
+
+    Attributes
+    ----------
+    path : str
+        Path to the SQLite database.
+    '''
+    def __init__(self, path):
+        super(UbiSqliteCredentialCache, self).__init__()
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS credential_hints '
+                '(host TEXT PRIMARY KEY, hint TEXT NOT NULL)'
+            )
+
+    def _load(self, host):
+        row = self._db.execute(
+            'SELECT hint FROM credential_hints WHERE host = ?', (host,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _store(self, host, hint):
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO credential_hints VALUES (?, ?)',
+                (host, hint)
+            )
+
+    def _delete(self, host):
+        with self._db:
+            self._db.execute(
+                'DELETE FROM credential_hints WHERE host = ?', (host,)
+            )
+
+
+DEFAULT_CREDENTIAL_CACHE = UbiCredentialCache()
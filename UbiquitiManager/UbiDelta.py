@@ -0,0 +1,242 @@
+import re
+import time
+import threading
+from collections import namedtuple
+from UbiquitiManager.UbiConfigStore import compile_pattern
+
+_MISSING = object()
+
+
+class UbiDelta(namedtuple('UbiDelta', ['host', 'path', 'timestamp',
+                                       'joined', 'left', 'changed',
+                                       'crossed'])):
+    '''
+    Changes of one page of one device since its previous poll. joined and
+    left list the ids of the list items (clients by mac, interfaces by
+    ifname...) which appeared or disappeared, changed maps the flattened
+    fields to (old value, new value) with None for a missing side, and
+    crossed lists (field, threshold, 'up' or 'down') for the numeric
+    thresholds crossed. The delta is false when nothing changed.
+    '''
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.joined or self.left or self.changed or self.crossed)
+
+    __nonzero__ = __bool__
+
+
+def flatten(data, item_keys=('mac', 'ifname'), prefix='', fields=None,
+            items=None):
+    '''
+    Flattens a JSON document to dotted fields. Items of a list of dicts
+    are named by their first item key found (a client by its mac), other
+    list items by their index.
+
+    Returns
+    -------
+    fields : dict
+        Dotted field to scalar value.
+    items : set
+        Dotted ids of the list items named by an item key.
+    '''
+    if fields is None:
+        fields, items = {}, set()
+    if isinstance(data, dict):
+        for key, value in data.items():
+            flatten(value, item_keys, prefix + str(key) + '.', fields, items)
+    elif isinstance(data, list):
+        for index, value in enumerate(data):
+            name = None
+            if isinstance(value, dict):
+                for key in item_keys:
+                    if value.get(key) is not None:
+                        name = str(value[key])
+                        items.add(prefix + name)
+                        break
+            if name is None:
+                name = str(index)
+            flatten(value, item_keys, prefix + name + '.', fields, items)
+    else:
+        fields[prefix[:-1]] = data
+    return fields, items
+
+
+class UbiDeltaTracker(object):
+    '''
+    Keeps the previous snapshot of each device and page, flattened, and
+    returns only what changed at each new poll, so storage and alerting
+    handle the changes instead of full documents.
+
+    Attributes
+    ----------
+    thresholds : dict
+        Field pattern (like '*.signal', see UbiConfigStore.match) to the
+        threshold value or list of values to watch.
+    ignore : list
+        Field patterns never reported as changed (like 'host.uptime').
+    item_keys : tuple
+        Keys naming the items of a list of dicts, see flatten.
+    stats : dict
+        Counters of updates, fields seen and fields changed.
+
+    Methods
+    -------
+    update(host, path, data)
+        Returns the UbiDelta against the previous snapshot.
+    update_connector(connector, paths=None)
+        Same, for the pages stored in connector.data.
+    sink(downstream, skip_empty=True)
+        Returns a UbiPoller sink sending deltas to downstream.
+    forget(host, path=None)
+        Drops snapshots.
+    '''
+    def __init__(self, thresholds=None, ignore=(),
+                 item_keys=('mac', 'ifname')):
+        self.thresholds = []
+        for pattern, values in (thresholds or {}).items():
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            self.thresholds.append(
+                (compile_pattern(pattern)[0], sorted(values))
+            )
+        self.ignore = list(ignore)
+        self._ignore = None
+        if self.ignore:
+            self._ignore = re.compile('|'.join(
+                '(?:{})'.format(compile_pattern(pattern)[0].pattern)
+                for pattern in self.ignore
+            ))
+        self.item_keys = tuple(item_keys)
+        self.stats = {'updates': 0, 'fields': 0, 'changed': 0}
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def _crossed(self, key, old, new):
+        if not isinstance(old, (int, float)) or \
+                not isinstance(new, (int, float)):
+            return []
+        crossed = []
+        for regex, values in self.thresholds:
+            if not regex.match(key):
+                continue
+            for value in values:
+                if old < value <= new:
+                    crossed.append((key, value, 'up'))
+                elif new < value <= old:
+                    crossed.append((key, value, 'down'))
+        return crossed
+
+    def update(self, host, path, data, timestamp=None):
+        '''
+        Stores data as the new snapshot of path on host and returns what
+        changed since the previous one. On the first update everything is
+        reported as new.
+
+        Parameters
+        ----------
+        host : str
+            Device name.
+        path : str
+            Page of the data, like 'sta.cgi'.
+        data : dict or list
+            Document returned by the device.
+        timestamp : float, optional
+            Time of the poll, now by default.
+
+        Returns
+        -------
+        delta : UbiDelta
+        '''
+        fields, items = flatten(data, self.item_keys)
+        with self._lock:
+            old_fields, old_items = self._snapshots.get(
+                (host, path), ({}, set())
+            )
+            self._snapshots[(host, path)] = (fields, items)
+        changed = {}
+        for key, value in fields.items():
+            old = old_fields.get(key, _MISSING)
+            if old is _MISSING:
+                changed[key] = (None, value)
+            elif old != value:
+                changed[key] = (old, value)
+        if len(fields) - len(changed) < len(old_fields):
+            for key, value in old_fields.items():
+                if key not in fields:
+                    changed[key] = (value, None)
+        if self._ignore is not None:
+            changed = {
+                key: values for key, values in changed.items()
+                if not self._ignore.match(key)
+            }
+        crossed = []
+        if self.thresholds:
+            for key, values in changed.items():
+                crossed.extend(self._crossed(key, *values))
+        with self._lock:
+            self.stats['updates'] += 1
+            self.stats['fields'] += len(fields)
+            self.stats['changed'] += len(changed)
+        return UbiDelta(
+            host,
+            path,
+            time.time() if timestamp is None else timestamp,
+            sorted(items - old_items),
+            sorted(old_items - items),
+            changed,
+            crossed
+        )
+
+    def update_connector(self, connector, paths=None):
+        '''
+        Tracks the pages last gathered by a UbiConnector (connector.data).
+
+        Parameters
+        ----------
+        connector : UbiConnector
+            Connector whose data is tracked, named by its name (hostname,
+            with ':port' when the port is not 80 or 443).
+        paths : list, optional
+            Pages to track, all the pages in connector.data by default.
+
+        Returns
+        -------
+        deltas : list
+            UbiDelta of each tracked page.
+        '''
+        if paths is None:
+            paths = list(connector.data)
+        return [
+            self.update(connector.name, path, connector.data[path])
+            for path in paths if path in connector.data
+        ]
+
+    def sink(self, downstream, skip_empty=True):
+        '''
+        Returns a UbiPoller sink turning each UbiPollResult into a UbiDelta
+        passed to downstream. Failed polls are not passed, nor empty deltas
+        unless skip_empty is False.
+        '''
+        def delta_sink(result):
+            if result.error is not None:
+                return
+            delta = self.update(
+                result.host,
+                result.path,
+                result.data,
+                result.timestamp
+            )
+            if delta or not skip_empty:
+                downstream(delta)
+        return delta_sink
+
+    def forget(self, host, path=None):
+        '''
+        Drops the snapshots of host (only of path when given), the next
+        update will report everything as new.
+        '''
+        with self._lock:
+            for key in [k for k in self._snapshots if k[0] == host]:
+                if path is None or key[1] == path:
+                    del self._snapshots[key]
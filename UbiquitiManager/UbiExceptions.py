@@ -50,3 +50,35 @@ class UbiConfigChangeFailed(Exception):
     fails or parameter is invalid raise this exception
     '''
     pass
+
+
+class UbiTimeoutException(Exception):
+    '''
+    If an operation on a device did not complete in the given time
+    raise this exception
+    '''
+    pass
+
+
+class UbiTaskException(Exception):
+    '''
+    If a task run against a device failed with an error which is not
+    an Ubi exception, it is wrapped in this exception
+    '''
+    pass
+
+
+class UbiRolloutHalted(Exception):
+    '''
+    If a rollout is stopped because too many devices failed raise this
+    exception
+    '''
+    pass
+
+
+class UbiCircuitOpen(Exception):
+    '''
+    If a device failed too many times recently and requests to it are
+    refused without being sent raise this exception
+    '''
+    pass
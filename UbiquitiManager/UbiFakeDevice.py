@@ -0,0 +1,628 @@
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import threading
+from functools import partial
+from urllib.parse import parse_qsl
+
+LOGIN_PAGE = (
+    '<html><body><form action="/login.cgi" method="post">'
+    '<table class="logintable"><tr><td>Username</td></tr></table>'
+    '</form></body></html>'
+)
+SESSION_COOKIE = 'AIROS_SESSIONID'
+REASONS = {
+    200: 'OK',
+    302: 'Found',
+    404: 'Not Found',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+def fake_config(name='fake', lines=1500, password='ubnt'):
+    '''
+    Returns a configuration text like the ones of airOS devices: sorted
+    key=value lines, ending with a newline.
+
+    Parameters
+    ----------
+    name : str
+        Host name of the device.
+    lines : int
+        Number of lines, filled with netconf/ebtables like keys.
+    password : str
+        Stored as the admin password (not hashed).
+    '''
+    config = {
+        'aaa.status': 'disabled',
+        'radio.status': 'enabled',
+        'radio.1.mode': 'master',
+        'radio.1.txpower': '20',
+        'radio.1.freq': '5180',
+        'radio.1.chanbw': '20',
+        'resolv.host.1.name': name,
+        'resolv.host.1.status': 'enabled',
+        'snmp.status': 'disabled',
+        'users.status': 'enabled',
+        'users.1.name': 'admin',
+        'users.1.password': password,
+        'users.1.status': 'enabled',
+        'wireless.1.ssid': 'fake-{}'.format(name),
+        'wireless.1.security.type': 'wpa2',
+    }
+    index = 1
+    while len(config) < lines:
+        for field in ('devname', 'status', 'up', 'mtu', 'netmask'):
+            config['netconf.{}.{}'.format(index, field)] = \
+                'value{}'.format(index % 17)
+        index += 1
+    return ''.join(
+        '{}={}\n'.format(key, config[key]) for key in sorted(config)[:lines]
+    )
+
+
+def _parse_form(content_type, body):
+    '''
+    Returns the fields of a multipart/form-data or urlencoded body, files
+    as (filename, bytes).
+    '''
+    fields = {}
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type or '')
+    if boundary is None:
+        return dict(parse_qsl(body.decode('latin1')))
+    for part in body.split(b'--' + boundary.group(1).encode('latin1'))[1:]:
+        if part.startswith(b'--'):
+            break
+        head, _, data = part[2:].partition(b'\r\n\r\n')
+        if data.endswith(b'\r\n'):
+            data = data[:-2]
+        head = head.decode('latin1')
+        name = re.search(r' name="([^"]*)"', head)
+        filename = re.search(r'filename="([^"]*)"', head)
+        if name is None:
+            continue
+        if filename is None:
+            fields[name.group(1)] = data.decode('utf-8', 'replace')
+        else:
+            fields[name.group(1)] = (filename.group(1), data)
+    return fields
+
+
+class UbiFakeDevice(object):
+    '''
+    Stand-in for an airOS device, answering login.cgi, cfg.cgi, status.cgi,
+    sta.cgi, system.cgi, apply.cgi and fwflash.cgi like the connector and
+    the config manager expect, for tests and benchmarks without hardware.
+    It only holds the device state, UbiFakeServer serves it.
+
+    Attributes
+    ----------
+    name : str
+        Host name of the device.
+    login : str
+        Accepted login.
+    password : str
+        Accepted password.
+    config : str
+        Saved configuration, returned by cfg.cgi.
+    clients : list
+        Wireless clients returned by sta.cgi.
+    latency : float or tuple
+        Seconds added to each answer, or (min, max) for a random delay.
+    failure_rate : float
+        Fraction of the requests answered with an HTTP 500.
+    session_lifetime : float
+        Seconds a session stays valid, None for ever.
+    flash_delay : float
+        Seconds between fwflash.cgi and the reboot.
+    reboot_delay : float
+        Seconds the device stays down when rebooting.
+    apply_delay : float
+        Seconds the device stays down when a config test starts.
+    test_revert : float
+        Seconds after which a tested config is reverted if not confirmed.
+    host : str
+        Address the device is served on, set by UbiFakeServer.
+    port : int
+        Port the device is served on, set by UbiFakeServer.
+    stats : dict
+        Counters of connections, requests, logins, failed logins, injected
+        failures, config pushes, reverts and flashes, and the maximum of
+        requests being answered at once (max_in_flight).
+
+    Methods
+    -------
+    handle(method, target, headers, body)
+        Returns the (status, headers, body) answer to a request.
+    '''
+
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, name='fake', login='admin', password='ubnt',
+                 config=None, clients=10, config_lines=1500, latency=0,
+                 failure_rate=0, session_lifetime=None, flash_delay=1,
+                 reboot_delay=5, apply_delay=0, test_revert=180):
+        self.name = name
+        self.login = login
+        self.password = password
+        self.config = config
+        if config is None:
+            self.config = fake_config(name, config_lines, password)
+        self.clients = [self._client(index) for index in range(clients)]
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.session_lifetime = session_lifetime
+        self.flash_delay = flash_delay
+        self.reboot_delay = reboot_delay
+        self.apply_delay = apply_delay
+        self.test_revert = test_revert
+        self.host = None
+        self.port = None
+        self.version = 'XM.v6.1.0'
+        self.boot_time = time.time()
+        self.restart = None
+        self.in_flight = 0
+        self.stats = {
+            'connections': 0,
+            'max_in_flight': 0,
+            'requests': 0,
+            'logins': 0,
+            'failed_logins': 0,
+            'failures': 0,
+            'config_pushes': 0,
+            'reverts': 0,
+            'flashes': 0,
+        }
+        self._sessions = {}
+        self._uploaded_config = None
+        self._saved_config = None
+        self._test_deadline = None
+        self._firmware = None
+
+    def _client(self, index):
+        mac = '02:00:{:02X}:{:02X}:{:02X}:{:02X}'.format(
+            random.randint(0, 255), random.randint(0, 255),
+            index // 256 % 256, index % 256
+        )
+        signal = random.randint(-85, -45)
+        return {
+            'mac': mac,
+            'name': 'client-{}'.format(index),
+            'lastip': '10.0.{}.{}'.format(index // 250 % 250, index % 250 + 2),
+            'signal': signal,
+            'rssi': signal + 96,
+            'noisefloor': -96,
+            'ccq': random.randint(50, 100),
+            'tx': random.choice([65, 130, 150, 300]),
+            'rx': random.choice([65, 130, 150, 300]),
+            'airmax': {'quality': random.randint(50, 100)},
+            'uptime': random.randint(10, 100000),
+            'stats': {'tx_bytes': 0, 'rx_bytes': 0},
+        }
+
+    def delay(self):
+        '''
+        Returns the seconds to wait before answering a request.
+        '''
+        if isinstance(self.latency, (tuple, list)):
+            return random.uniform(*self.latency)
+        return self.latency
+
+    def reset_sessions(self):
+        '''
+        Forgets all the sessions, like after a reboot.
+        '''
+        self._sessions.clear()
+
+    def _session(self, headers):
+        cookie = re.search(
+            SESSION_COOKIE + r'=([0-9a-f]+)', headers.get('cookie', '')
+        )
+        return cookie.group(1) if cookie else None
+
+    def _authenticated(self, session):
+        started = self._sessions.get(session)
+        if started is None:
+            return False
+        if self.session_lifetime is not None and \
+                started + self.session_lifetime < time.time():
+            del self._sessions[session]
+            return False
+        return True
+
+    @staticmethod
+    def _answer(body, content_type='text/html', status=200, headers=None):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        headers = list(headers or [])
+        headers.append(('Content-Type', content_type))
+        return status, headers, body
+
+    def _check_test(self):
+        if self._test_deadline is not None and \
+                self._test_deadline < time.time():
+            self.config = self._saved_config
+            self._test_deadline = None
+            self.stats['reverts'] += 1
+
+    def handle(self, method, target, headers, body=b''):
+        '''
+        Answers a request.
+
+        Parameters
+        ----------
+        method : str
+            GET or POST.
+        target : str
+            Requested path with its query string.
+        headers : dict
+            Request headers, lower case names.
+        body : bytes
+            Request body.
+
+        Returns
+        -------
+        answer : tuple
+            (status, list of (header, value), body bytes).
+        '''
+        self.stats['requests'] += 1
+        self._check_test()
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.stats['failures'] += 1
+            return self._answer('injected failure', status=500)
+        path = target.split('?')[0].lstrip('/')
+        session = self._session(headers)
+        if path == 'login.cgi':
+            return self._login(method, headers, body, session)
+        if not self._authenticated(session):
+            return self._answer('', status=302, headers=[
+                ('Location', '/login.cgi?uri=/{}'.format(path))
+            ])
+        handler = getattr(self, '_' + path.replace('.cgi', '_cgi'), None)
+        if handler is None or not path.endswith('.cgi'):
+            return self._answer('not found', status=404)
+        form = {}
+        if method == 'POST':
+            form = _parse_form(headers.get('content-type'), body)
+        return handler(method, target, form)
+
+    def _login(self, method, headers, body, session):
+        cookies = []
+        if session is None:
+            session = uuid.uuid4().hex
+            cookies.append((
+                'Set-Cookie', '{}={}; Path=/'.format(SESSION_COOKIE, session)
+            ))
+        if method == 'POST':
+            form = _parse_form(headers.get('content-type'), body)
+            if form.get('username') == self.login and \
+                    form.get('password') == self.password:
+                self.stats['logins'] += 1
+                self._sessions[session] = time.time()
+                return self._answer('', status=302, headers=cookies + [
+                    ('Location', '/index.cgi')
+                ])
+            self.stats['failed_logins'] += 1
+        return self._answer(LOGIN_PAGE, headers=cookies)
+
+    def _index_cgi(self, method, target, form):
+        return self._answer('<html><body>{}</body></html>'.format(self.name))
+
+    def _cfg_cgi(self, method, target, form):
+        return self._answer(self.config, 'text/plain')
+
+    def _status_cgi(self, method, target, form):
+        uptime = int(time.time() - self.boot_time)
+        return self._answer(json.dumps({
+            'host': {
+                'hostname': self.name,
+                'uptime': uptime,
+                'fwversion': self.version,
+                'devmodel': 'NanoStation M5',
+            },
+            'wireless': {
+                'essid': 'fake-{}'.format(self.name),
+                'frequency': '5180 MHz',
+                'count': len(self.clients),
+            },
+            'interfaces': [
+                {
+                    'ifname': ifname,
+                    'enabled': True,
+                    'status': {
+                        'plugged': 1,
+                        'rx_bytes': uptime * 1000,
+                        'tx_bytes': uptime * 4000,
+                    },
+                }
+                for ifname in ('eth0', 'ath0')
+            ],
+        }), 'application/json')
+
+    def _sta_cgi(self, method, target, form):
+        for client in self.clients:
+            client['signal'] = max(-95, min(-30, client['signal'] +
+                                            random.randint(-2, 2)))
+            client['rssi'] = client['signal'] + 96
+            client['stats']['tx_bytes'] += random.randint(0, 100000)
+            client['stats']['rx_bytes'] += random.randint(0, 100000)
+        return self._answer(json.dumps(self.clients), 'application/json')
+
+    def _system_cgi(self, method, target, form):
+        action = form.get('action')
+        if action == 'cfgupload' and isinstance(form.get('cfgfile'), tuple):
+            self._uploaded_config = form['cfgfile'][1].decode('utf-8')
+        elif action == 'fwupload':
+            firmware = form.get('fwfile')
+            if not isinstance(firmware, tuple) or not firmware[1]:
+                return self._answer(
+                    '<div id="error">Invalid firmware file</div>'
+                )
+            self._firmware = len(firmware[1])
+        return self._answer('<html><body>System</body></html>')
+
+    def _apply_cgi(self, method, target, form):
+        if self._uploaded_config is not None:
+            self.stats['config_pushes'] += 1
+            if self._test_deadline is None:
+                self._saved_config = self.config
+            self.config = self._uploaded_config
+            self._uploaded_config = None
+        if form.get('testmode') == 'on':
+            self._test_deadline = time.time() + self.test_revert
+            if self.apply_delay:
+                self.restart = (0, self.apply_delay, True)
+        else:
+            self._test_deadline = None
+        return self._answer('<html><body>Applied</body></html>')
+
+    def _fwflash_cgi(self, method, target, form):
+        if self._firmware is None:
+            return self._answer('<div id="error">No firmware</div>')
+        self._firmware = None
+        self.stats['flashes'] += 1
+        self.version = 'XM.v6.1.{}'.format(self.stats['flashes'])
+        self.restart = (self.flash_delay, self.reboot_delay, False)
+        return self._answer('<html><body>Flashing</body></html>')
+
+
+class UbiFakeServer(object):
+    '''
+    Serves UbiFakeDevice instances, each on its own listening port, from a
+    single asyncio event loop running in a background thread, so thousands
+    of devices fit in one process. A rebooting device closes its port and
+    connections for its reboot delay, like a real one.
+
+    Attributes
+    ----------
+    devices : list
+        Served UbiFakeDevice.
+    ssl_context : ssl.SSLContext
+        Serve https with this context, http when None.
+
+    Methods
+    -------
+    fleet(count, ...)
+        Starts a server with count devices.
+    add(device, host='127.0.0.1', port=0)
+        Serves a device, port 0 picking a free port.
+    inventory()
+        Returns the UbiConnector parameters of each device.
+    reboot(device, delay=None)
+        Makes a device unreachable for delay seconds.
+    stop()
+        Stops the server.
+    '''
+    def __init__(self, ssl_context=None):
+        self.devices = []
+        self.ssl_context = ssl_context
+        self._listeners = {}
+        self._connections = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @classmethod
+    def fleet(cls, count, host='127.0.0.1', base_port=0, ssl_context=None,
+              **device_options):
+        '''
+        Starts a server with count devices named fake-0, fake-1...
+
+        Parameters
+        ----------
+        count : int
+            Number of devices.
+        host : str
+            Address to listen on.
+        base_port : int
+            Port of the first device, the next ones following, 0 for free
+            ports.
+        ssl_context : ssl.SSLContext, optional
+            Serve https with this context.
+        device_options : dict
+            UbiFakeDevice parameters.
+        '''
+        server = cls(ssl_context)
+        devices = [
+            UbiFakeDevice(name='fake-{}'.format(index), **device_options)
+            for index in range(count)
+        ]
+        for index, device in enumerate(devices):
+            device.host = host
+            device.port = base_port + index if base_port else 0
+        server._call(server._add_all(devices))
+        return server
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _add_all(self, devices):
+        for device in devices:
+            await self._listen(device)
+            self.devices.append(device)
+
+    async def _listen(self, device):
+        listener = await asyncio.start_server(
+            partial(self._serve, device),
+            device.host,
+            device.port,
+            ssl=self.ssl_context
+        )
+        device.port = listener.sockets[0].getsockname()[1]
+        self._listeners[id(device)] = listener
+
+    def add(self, device, host='127.0.0.1', port=0):
+        '''
+        Serves device on host and port, port 0 picking a free port.
+
+        Returns
+        -------
+        device : UbiFakeDevice
+            The device, with its host and port set.
+        '''
+        device.host = host
+        device.port = port
+        self._call(self._add_all([device]))
+        return device
+
+    def inventory(self, **options):
+        '''
+        Returns one dict of UbiConnector parameters per device, usable as
+        UbiFleet or UbiPoller inventory, options being added to each.
+        '''
+        protocol = 'http' if self.ssl_context is None else 'https'
+        entries = []
+        for device in self.devices:
+            entry = {
+                'host': device.host,
+                'address': device.host,
+                'port': device.port,
+                'protocol': protocol,
+                'login': device.login,
+                'password': device.password,
+            }
+            entry.update(options)
+            entries.append(entry)
+        return entries
+
+    def reboot(self, device, delay=None):
+        '''
+        Makes device unreachable for delay seconds (its reboot_delay by
+        default) and forgets its sessions.
+        '''
+        self._loop.call_soon_threadsafe(
+            self._down,
+            device,
+            device.reboot_delay if delay is None else delay,
+            False
+        )
+
+    def _down(self, device, delay, keep_sessions):
+        listener = self._listeners.pop(id(device), None)
+        if listener is None:
+            return
+        listener.close()
+        for writer in list(self._connections.get(id(device), ())):
+            writer.close()
+        if not keep_sessions:
+            device.reset_sessions()
+
+        def up():
+            device.boot_time = time.time()
+            asyncio.ensure_future(self._listen(device))
+        self._loop.call_later(delay, up)
+
+    @staticmethod
+    async def _read_request(reader):
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method, target, _ = line.decode('latin1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = b''
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                chunks.append(await reader.readexactly(size + 2))
+                if not size:
+                    break
+            body = b''.join(chunk[:-2] for chunk in chunks)
+        elif headers.get('content-length'):
+            body = await reader.readexactly(int(headers['content-length']))
+        return method, target, headers, body
+
+    async def _serve(self, device, reader, writer):
+        connections = self._connections.setdefault(id(device), set())
+        connections.add(writer)
+        device.stats['connections'] += 1
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                device.in_flight += 1
+                device.stats['max_in_flight'] = max(
+                    device.stats['max_in_flight'],
+                    device.in_flight
+                )
+                try:
+                    delay = device.delay()
+                    if delay:
+                        await asyncio.sleep(delay)
+                    status, headers, body = device.handle(*request)
+                finally:
+                    device.in_flight -= 1
+                head = ['HTTP/1.1 {} {}'.format(status, REASONS[status])]
+                head.extend('{}: {}'.format(*header) for header in headers)
+                head.append('Content-Length: {}'.format(len(body)))
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin1'))
+                writer.write(body)
+                await writer.drain()
+                if device.restart is not None:
+                    after, down_for, keep_sessions = device.restart
+                    device.restart = None
+                    self._loop.call_later(
+                        after, self._down, device, down_for, keep_sessions
+                    )
+                if request[2].get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            connections.discard(writer)
+            writer.close()
+
+    def stop(self):
+        '''
+        Closes all the ports and stops the event loop.
+        '''
+        async def close():
+            for listener in self._listeners.values():
+                listener.close()
+            for connections in self._connections.values():
+                for writer in list(connections):
+                    writer.close()
+            self._listeners.clear()
+        if self._loop.is_running():
+            self._call(close())
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
@@ -0,0 +1,289 @@
+import time
+import inspect
+from collections import namedtuple
+from concurrent.futures import wait
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED
+from UbiquitiManager import UbiExceptions
+from UbiquitiManager.UbiConnector import UbiConnector
+from UbiquitiManager.UbiConfigManager import UbiConfigManager
+from UbiquitiManager.UbiExceptions import UbiTaskException
+from UbiquitiManager.UbiExceptions import UbiTimeoutException
+from UbiquitiManager.UbiExceptions import UbiHostException
+from UbiquitiManager.UbiResolver import DEFAULT_RESOLVER
+
+UBI_EXCEPTIONS = tuple(
+    value for value in vars(UbiExceptions).values()
+    if isinstance(value, type) and issubclass(value, Exception)
+)
+
+CONNECTOR_PARAMETERS = tuple(
+    inspect.signature(UbiConnector.__init__).parameters
+)[1:]
+
+UbiFleetResult = namedtuple(
+    'UbiFleetResult',
+    ['host', 'result', 'error', 'duration', 'key']
+)
+UbiFleetResult.__doc__ = '''
+Outcome of a task on one device. error is None on success, else an Ubi
+exception (other errors are wrapped in UbiTaskException) and result is
+None. duration is the time spent running the task in seconds. key tells
+apart devices sharing a host, see entry_key.
+'''
+
+
+def entry_key(entry):
+    '''
+    Returns the name identifying an inventory entry: its 'id' if it has
+    one, else its host followed by ':port' when the port is not 80 or 443,
+    so devices behind the same address (port forwarding) are told apart.
+    '''
+    if entry.get('id') is not None:
+        return str(entry['id'])
+    port = entry.get('port')
+    if port is None or str(port) in ('80', '443'):
+        return str(entry['host'])
+    return '{}:{}'.format(entry['host'], port)
+
+
+def fleet_status(connector):
+    '''
+    Fleet task returning the status.cgi data of the device.
+    '''
+    return connector.ubi_request_get('status.cgi')
+
+
+def fleet_wirless_clients(connector):
+    '''
+    Fleet task returning the sta.cgi data of the device.
+    '''
+    return UbiConfigManager(connector).wirless_clients()
+
+
+def fleet_gather_config(connector):
+    '''
+    Fleet task returning the text configuration of the device.
+    '''
+    return UbiConfigManager(connector).config
+
+
+class UbiFleet(object):
+    '''
+    UbiFleet runs the same task against many devices on a bounded thread
+    pool. Each task gets its own UbiConnector and failures are reported
+    per host without stopping the other devices. Host names are resolved
+    all at once, concurrently and through the resolver cache, before the
+    tasks start.
+
+    Attributes
+    ----------
+    inventory : list
+        List of dict, each one holding the UbiConnector parameters of a
+        device (at least host), defaults are taken from connector_options.
+        Other keys (like a site name, or an 'id' naming the device in the
+        results) are kept for the tasks but not given to the connector.
+    max_workers : int
+        Maximum number of devices handled at the same time.
+    timeout : float
+        Time in seconds a task may run on a device before it is reported
+        as UbiTimeoutException. None means no limit.
+    connector_options : dict
+        Default UbiConnector parameters (login, password, protocol...).
+    resolver : UbiquitiManager.UbiResolver.UbiResolver
+        The resolver connector option, or the default one.
+
+    Methods
+    -------
+    run(task, callback=None, with_entry=False)
+        Generator yielding UbiFleetResult as tasks complete.
+    run_all(task, callback=None, with_entry=False)
+        Runs the task on all devices and returns the list of results.
+    '''
+    def __init__(self, inventory, max_workers=32, timeout=None,
+                 **connector_options):
+        self.connector_options = connector_options
+        self.inventory = [self._entry(item) for item in inventory]
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.resolver = connector_options.get('resolver') or DEFAULT_RESOLVER
+
+    def _entry(self, item):
+        entry = dict(self.connector_options)
+        if isinstance(item, dict):
+            entry.update(item)
+        else:
+            entry['host'] = str(item)
+        return entry
+
+    def _connector(self, entry):
+        return UbiConnector(**{
+            key: value for key, value in entry.items()
+            if key in CONNECTOR_PARAMETERS
+        })
+
+    def _execute(self, index, entry, task, started, with_entry):
+        started[index] = time.time()
+        if with_entry:
+            return task(self._connector(entry), entry)
+        return task(self._connector(entry))
+
+    @staticmethod
+    def _error(excpt):
+        if isinstance(excpt, UBI_EXCEPTIONS):
+            return excpt
+        error = UbiTaskException(
+            '{}: {}'.format(type(excpt).__name__, str(excpt))
+        )
+        error.__cause__ = excpt
+        return error
+
+    def _resolve(self):
+        '''
+        Returns the inventory with the address of every host, and the
+        results of the hosts which could not be resolved.
+        '''
+        addresses = self.resolver.resolve_many(
+            entry['host'] for entry in self.inventory
+            if not entry.get('address')
+        )
+        entries = []
+        failures = []
+        for index, entry in enumerate(self.inventory):
+            if not entry.get('address'):
+                address = addresses[str(entry['host'])]
+                if isinstance(address, UbiHostException):
+                    failures.append(
+                        UbiFleetResult(
+                            entry['host'], None, address, 0, entry_key(entry)
+                        )
+                    )
+                    continue
+                entry = dict(entry, address=address)
+            entries.append((index, entry))
+        return entries, failures
+
+    def _result(self, future, entry, started, index):
+        duration = time.time() - started.get(index, time.time())
+        try:
+            return UbiFleetResult(entry['host'], future.result(), None,
+                                  duration, entry_key(entry))
+        except Exception as excpt:
+            return UbiFleetResult(entry['host'], None, self._error(excpt),
+                                  duration, entry_key(entry))
+
+    def _expired(self, pending, futures, started):
+        now = time.time()
+        expired = []
+        for future in pending:
+            start = started.get(futures[future])
+            if start is not None and now - start >= self.timeout:
+                expired.append(future)
+        return expired
+
+    def _next_wait(self, pending, futures, started):
+        if self.timeout is None:
+            return None
+        starts = [
+            started[futures[future]] for future in pending
+            if futures[future] in started
+        ]
+        if not starts:
+            return self.timeout
+        return max(0, min(starts) + self.timeout - time.time())
+
+    def run(self, task, callback=None, with_entry=False):
+        '''
+        Runs task(connector) for every device of the inventory, yielding
+        results as soon as they are available.
+
+        Parameters
+        ----------
+        task : callable
+            Called with a UbiConnector for the device, its return value is
+            the result of the device.
+        callback : callable, optional
+            Called with each UbiFleetResult before it is yielded.
+        with_entry : bool, optional
+            Call task(connector, entry) with the inventory entry of the
+            device as second argument.
+
+        Yields
+        ------
+        result : UbiFleetResult
+            One per device, in completion order. A device running longer
+            than timeout gets a UbiTimeoutException error; its thread can
+            not be interrupted and keeps its worker until the connector
+            timeouts fire, so keep them coherent with the fleet timeout.
+        '''
+        started = {}
+        entries, failures = self._resolve()
+        for result in failures:
+            if callback is not None:
+                callback(result)
+            yield result
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = {}
+        for index, entry in entries:
+            future = executor.submit(
+                self._execute, index, entry, task, started, with_entry
+            )
+            futures[future] = index
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(
+                    pending,
+                    timeout=self._next_wait(pending, futures, started),
+                    return_when=FIRST_COMPLETED
+                )
+                results = []
+                for future in done:
+                    index = futures[future]
+                    results.append(self._result(
+                        future, self.inventory[index], started, index
+                    ))
+                if self.timeout is not None:
+                    for future in self._expired(pending, futures, started):
+                        pending.discard(future)
+                        index = futures[future]
+                        results.append(UbiFleetResult(
+                            self.inventory[index]['host'],
+                            None,
+                            UbiTimeoutException(
+                                'Task did not complete in {}s'.format(
+                                    self.timeout
+                                )
+                            ),
+                            time.time() - started[index],
+                            entry_key(self.inventory[index])
+                        ))
+                for result in results:
+                    if callback is not None:
+                        callback(result)
+                    yield result
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def run_all(self, task, callback=None, with_entry=False):
+        '''
+        Runs task(connector) for every device of the inventory and waits
+        for all of them.
+
+        Parameters
+        ----------
+        task : callable
+            Called with a UbiConnector for the device.
+        callback : callable, optional
+            Called with each UbiFleetResult as it completes.
+        with_entry : bool, optional
+            Call task(connector, entry), see run.
+
+        Returns
+        -------
+        results : list
+            List of UbiFleetResult, in completion order.
+        '''
+        return list(self.run(task, callback, with_entry))
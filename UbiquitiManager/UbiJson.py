@@ -0,0 +1,79 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+if orjson is not None:
+    JSON_BACKEND = 'orjson'
+    _loads = orjson.loads
+elif ujson is not None:
+    JSON_BACKEND = 'ujson'
+    _loads = ujson.loads
+else:
+    JSON_BACKEND = 'json'
+    _loads = json.loads
+
+
+def loads(data):
+    '''
+    Parses JSON from str or bytes with the fastest backend installed:
+    orjson, ujson, or the standard json module
+    (pip install UbiquitiManager[fastjson]).
+
+    Raises
+    ------
+    ValueError
+        If data is not valid JSON.
+    '''
+    if JSON_BACKEND == 'json' and isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return _loads(data)
+
+
+def looks_like_json(content_type, body):
+    '''
+    Tells, without parsing, if an answer should be decoded as JSON: its
+    content type says so, or its first non blank character opens an object
+    or an array. Pages like cfg.cgi or HTML are then returned as text
+    without a failed parse.
+
+    Parameters
+    ----------
+    content_type : str
+        Content-Type header of the answer, or None.
+    body : bytes or str
+        Body of the answer.
+    '''
+    if content_type and 'json' in content_type:
+        return True
+    start = body[:64].lstrip()[:1]
+    return start in (b'{', b'[') if isinstance(body, bytes) \
+        else start in ('{', '[')
+
+
+def decode(content_type, body):
+    '''
+    Decodes an answer as JSON when looks_like_json says it is.
+
+    Returns
+    -------
+    is_json : bool
+        True if body was decoded, False if it does not look like JSON.
+    data : dict or list
+        Decoded data, None when is_json is False.
+
+    Raises
+    ------
+    ValueError
+        If body looks like JSON but is not valid JSON.
+    '''
+    if not looks_like_json(content_type, body):
+        return False, None
+    return True, loads(body)
@@ -0,0 +1,283 @@
+import threading
+from bisect import bisect_left
+
+# Upper bounds in seconds of the request latency histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'
+    )
+
+
+def _labels(names, values, extra=''):
+    labels = ','.join(
+        '{}="{}"'.format(name, _label_value(value))
+        for name, value in zip(names, values)
+    )
+    if extra:
+        labels = '{},{}'.format(labels, extra) if labels else extra
+    return '{' + labels + '}' if labels else ''
+
+
+class UbiMetrics(object):
+    '''
+    Records what the connectors do: request latency histograms and bytes
+    by host and path, answers by status, login attempts, JSON parse
+    failures and exceptions. Give the same instance to many connectors
+    (metrics parameter, also through UbiFleet) to aggregate a fleet, read
+    it with snapshot, slowest or to_prometheus, or register hooks to
+    receive every event as it happens.
+
+    Hosts are named by the connector hostname, followed by ':port' when
+    the port is not 80 or 443. Paths are recorded without their query
+    string.
+
+    Attributes
+    ----------
+    buckets : tuple
+        Upper bounds of the latency histogram buckets, in seconds.
+
+    Methods
+    -------
+    add_hook(hook)
+        Calls hook(event, fields) on every recorded event.
+    remove_hook(hook)
+        Stops calling hook.
+    snapshot()
+        Returns a copy of the counters and histograms.
+    slowest(count=10, path=None)
+        Hosts with the highest mean request latency.
+    to_prometheus()
+        Returns the metrics in the Prometheus text format.
+    reset()
+        Clears everything recorded.
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._hooks = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Clears the recorded counters and histograms.
+        '''
+        with self._lock:
+            self._latency = {}
+            self._counters = {}
+
+    def add_hook(self, hook):
+        '''
+        Registers hook, called with (event, fields) for every event:
+        'request' (host, path, method, status, duration, sent, received),
+        'login' (host, attempts, success, duration), 'parse_failure'
+        (host, path) and 'error' (host, path, exception). Hooks run in the
+        thread of the request and should be quick.
+        '''
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        '''
+        Unregisters hook.
+        '''
+        self._hooks.remove(hook)
+
+    def _count(self, name, labels, value=1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def _emit(self, event, fields):
+        for hook in list(self._hooks):
+            hook(event, fields)
+
+    def request(self, host, path, method, status, duration, sent=0,
+                received=0):
+        '''
+        Records an HTTP exchange with a device.
+
+        Parameters
+        ----------
+        host : str
+            Device name.
+        path : str
+            Requested path.
+        method : str
+            GET or POST.
+        status : int
+            HTTP status of the answer.
+        duration : float
+            Seconds until the answer was read.
+        sent : int
+            Bytes of the request body.
+        received : int
+            Bytes of the answer body.
+        '''
+        path = path.split('?')[0]
+        with self._lock:
+            key = (host, path, method)
+            histogram = self._latency.get(key)
+            if histogram is None:
+                histogram = self._latency[key] = \
+                    [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect_left(self.buckets, duration)] += 1
+            histogram[1] += duration
+            histogram[2] += 1
+            self._count('responses', (host, path, status))
+            if sent:
+                self._count('bytes_sent', (host, path), sent)
+            if received:
+                self._count('bytes_received', (host, path), received)
+        if self._hooks:
+            self._emit('request', {
+                'host': host, 'path': path, 'method': method,
+                'status': status, 'duration': duration, 'sent': sent,
+                'received': received,
+            })
+
+    def login(self, host, attempts, success, duration):
+        '''
+        Records a login: number of passwords tried, whether one worked and
+        how long it took.
+        '''
+        with self._lock:
+            self._count('login_attempts', (host,), attempts)
+            self._count('logins', (host, 'success' if success else 'failure'))
+        if self._hooks:
+            self._emit('login', {
+                'host': host, 'attempts': attempts, 'success': success,
+                'duration': duration,
+            })
+
+    def parse_failure(self, host, path):
+        '''
+        Records an answer which looked like JSON but could not be parsed,
+        returned as text.
+        '''
+        path = path.split('?')[0]
+        with self._lock:
+            self._count('parse_failures', (host, path))
+        if self._hooks:
+            self._emit('parse_failure', {'host': host, 'path': path})
+
+    def error(self, host, path, exception):
+        '''
+        Records an exception raised while talking to a device.
+        '''
+        path = path.split('?')[0]
+        with self._lock:
+            self._count('errors', (host, path, type(exception).__name__))
+        if self._hooks:
+            self._emit('error', {
+                'host': host, 'path': path, 'exception': exception,
+            })
+
+    def snapshot(self):
+        '''
+        Returns a copy of what was recorded.
+
+        Returns
+        -------
+        snapshot : dict
+            'latency' maps (host, path, method) to (bucket counts, sum,
+            count), the last bucket counting what is above the highest
+            bound. The other keys ('responses', 'bytes_sent',
+            'bytes_received', 'login_attempts', 'logins', 'parse_failures',
+            'errors') map label tuples to counts.
+        '''
+        with self._lock:
+            snapshot = {
+                'latency': {
+                    key: (list(value[0]), value[1], value[2])
+                    for key, value in self._latency.items()
+                }
+            }
+            for (name, labels), value in self._counters.items():
+                snapshot.setdefault(name, {})[labels] = value
+        return snapshot
+
+    def slowest(self, count=10, path=None):
+        '''
+        Returns the hosts with the highest mean request latency.
+
+        Parameters
+        ----------
+        count : int
+            Number of hosts returned.
+        path : str, optional
+            Only consider the requests of this path.
+
+        Returns
+        -------
+        hosts : list
+            (mean seconds, host, requests) sorted slowest first.
+        '''
+        totals = {}
+        with self._lock:
+            for (host, request_path, _), value in self._latency.items():
+                if path is not None and request_path != path:
+                    continue
+                total = totals.setdefault(host, [0.0, 0])
+                total[0] += value[1]
+                total[1] += value[2]
+        return sorted(
+            ((total / requests, host, requests)
+             for host, (total, requests) in totals.items() if requests),
+            reverse=True
+        )[:count]
+
+    def to_prometheus(self, prefix='ubi'):
+        '''
+        Returns the recorded metrics in the Prometheus text exposition
+        format, to be served on a /metrics page or written for the node
+        exporter textfile collector.
+        '''
+        snapshot = self.snapshot()
+        lines = []
+        name = '{}_request_duration_seconds'.format(prefix)
+        lines.append('# HELP {} Latency of the requests to devices.'.format(
+            name
+        ))
+        lines.append('# TYPE {} histogram'.format(name))
+        names = ('host', 'path', 'method')
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for key in sorted(snapshot['latency']):
+            buckets, total, count = snapshot['latency'][key]
+            cumulated = 0
+            for bound, bucket in zip(bounds, buckets):
+                cumulated += bucket
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(names, key, 'le="{}"'.format(bound)),
+                    cumulated
+                ))
+            lines.append('{}_sum{} {}'.format(
+                name, _labels(names, key), total
+            ))
+            lines.append('{}_count{} {}'.format(
+                name, _labels(names, key), count
+            ))
+        counters = (
+            ('responses', ('host', 'path', 'status'),
+             'Answers of the devices by HTTP status.'),
+            ('bytes_sent', ('host', 'path'), 'Bytes of the request bodies.'),
+            ('bytes_received', ('host', 'path'),
+             'Bytes of the answer bodies.'),
+            ('login_attempts', ('host',), 'Passwords tried on login.cgi.'),
+            ('logins', ('host', 'result'), 'Logins by result.'),
+            ('parse_failures', ('host', 'path'),
+             'Answers looking like JSON which failed to parse.'),
+            ('errors', ('host', 'path', 'exception'),
+             'Exceptions raised by requests to devices.'),
+        )
+        for counter, names, description in counters:
+            name = '{}_{}_total'.format(prefix, counter)
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} counter'.format(name))
+            values = snapshot.get(counter, {})
+            for labels in sorted(values, key=lambda key: tuple(map(str, key))):
+                lines.append('{}{} {}'.format(
+                    name, _labels(names, labels), values[labels]
+                ))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,247 @@
+import time
+import json
+import heapq
+import random
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from UbiquitiManager.UbiConnector import UbiConnector
+from UbiquitiManager.UbiResolver import load_inventory
+from UbiquitiManager.UbiFleet import CONNECTOR_PARAMETERS
+
+UbiPollResult = namedtuple(
+    'UbiPollResult',
+    ['host', 'path', 'timestamp', 'duration', 'data', 'error']
+)
+UbiPollResult.__doc__ = '''
+One poll of one path on one device. host is the connector name (hostname,
+with ':port' when the port is not 80 or 443), timestamp is when the
+request was sent, duration how long it took, data the returned data or
+None and error the exception raised or None.
+'''
+
+
+class UbiJsonlSink(object):
+    '''
+    Poller sink appending each result as a JSON line to a file.
+
+    Attributes
+    ----------
+    path : str
+        Path of the JSON lines file.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def __call__(self, result):
+        line = json.dumps({
+            'host': result.host,
+            'path': result.path,
+            'timestamp': result.timestamp,
+            'duration': result.duration,
+            'data': result.data,
+            'error': None if result.error is None else str(result.error),
+        })
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        '''
+        Closes the file.
+        '''
+        self._file.close()
+
+
+class UbiQueueSink(object):
+    '''
+    Poller sink putting each result in a queue (queue.Queue or any object
+    with a put method), for a consumer thread.
+    '''
+    def __init__(self, queue):
+        self.queue = queue
+
+    def __call__(self, result):
+        self.queue.put(result)
+
+
+class UbiPoller(object):
+    '''
+    UbiPoller polls the same pages (status.cgi, sta.cgi...) on many devices
+    at a fixed interval. Devices are spread evenly (with some jitter) over
+    the interval instead of being polled all at once, the schedule does not
+    drift with poll durations, the connectors keep their sessions between
+    polls, and a device whose previous poll is still running skips its
+    turn.
+
+    Attributes
+    ----------
+    connectors : list
+        UbiConnector of the polled devices.
+    paths : list
+        Paths requested on each device at each poll.
+    interval : float
+        Seconds between two polls of the same device.
+    sink : callable
+        Called with each UbiPollResult, like UbiJsonlSink, UbiQueueSink or
+        any function.
+    jitter : float
+        Fraction of a device slot randomly added to its offset.
+    stats : dict
+        Counters of polls, errors and skipped polls.
+
+    Methods
+    -------
+    from_inventory(inventory, ...)
+        Builds a poller and its connectors from an inventory.
+    run(duration=None)
+        Polls until stopped or for duration seconds.
+    start()
+        Runs the poller in a background thread.
+    stop()
+        Stops the poller.
+    '''
+
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, connectors, paths=('status.cgi',), interval=60,
+                 sink=None, max_workers=32, jitter=0.5, timeout=(3, 30)):
+        self.connectors = list(connectors)
+        self.paths = list(paths)
+        self.interval = interval
+        self.sink = sink
+        self.max_workers = max_workers
+        self.jitter = jitter
+        self.timeout = timeout
+        self.stats = {'polls': 0, 'errors': 0, 'skipped': 0}
+        self._outstanding = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_inventory(cls, inventory, connector_options=None, **options):
+        '''
+        Builds a poller from an inventory, resolving all hosts at once.
+        Hosts that could not be resolved are retried at each poll. The
+        results go to the sink, so the connectors do not keep them in
+        their data unless retain_data is given in connector_options.
+
+        Parameters
+        ----------
+        inventory : list
+            Host names or dict of UbiConnector parameters.
+        connector_options : dict, optional
+            Default UbiConnector parameters (login, password...).
+        options : dict
+            UbiPoller parameters.
+        '''
+        connectors = []
+        connector_options = dict(connector_options or {})
+        connector_options.setdefault('retain_data', False)
+        resolver = connector_options.pop('resolver', None)
+        for entry in load_inventory(inventory, resolver, **connector_options):
+            entry.setdefault('resolver', resolver)
+            connectors.append(UbiConnector(lazy_resolve=True, **{
+                key: value for key, value in entry.items()
+                if key in CONNECTOR_PARAMETERS
+            }))
+        return cls(connectors, **options)
+
+    def _schedule(self, start):
+        '''
+        Returns the heap of (first poll time, device index), devices being
+        spread evenly over the interval.
+        '''
+        slot = self.interval / float(max(len(self.connectors), 1))
+        order = list(range(len(self.connectors)))
+        random.shuffle(order)
+        heap = [
+            (start + (rank + random.random() * self.jitter) * slot, index)
+            for rank, index in enumerate(order)
+        ]
+        heapq.heapify(heap)
+        return heap
+
+    def _emit(self, result):
+        if result.error is not None:
+            with self._lock:
+                self.stats['errors'] += 1
+        if self.sink is not None:
+            self.sink(result)
+
+    def _poll(self, index):
+        connector = self.connectors[index]
+        try:
+            for path in self.paths:
+                timestamp = time.time()
+                try:
+                    data = connector.ubi_request_get(path, self.timeout)
+                    error = None
+                except Exception as excpt:
+                    data, error = None, excpt
+                self._emit(UbiPollResult(
+                    connector.name,
+                    path,
+                    timestamp,
+                    time.time() - timestamp,
+                    data,
+                    error
+                ))
+        finally:
+            with self._lock:
+                self._outstanding.discard(index)
+
+    def run(self, duration=None):
+        '''
+        Polls the devices until stop is called, or for duration seconds.
+
+        Parameters
+        ----------
+        duration : float, optional
+            Seconds to run, None to run until stopped.
+        '''
+        self._stop.clear()
+        self._run(duration)
+
+    def _run(self, duration=None):
+        start = time.time()
+        heap = self._schedule(start)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while heap and not self._stop.is_set():
+                due, index = heap[0]
+                if duration is not None and due > start + duration:
+                    break
+                if self._stop.wait(max(0, due - time.time())):
+                    break
+                heapq.heapreplace(heap, (due + self.interval, index))
+                with self._lock:
+                    if index in self._outstanding:
+                        self.stats['skipped'] += 1
+                        continue
+                    self._outstanding.add(index)
+                    self.stats['polls'] += 1
+                executor.submit(self._poll, index)
+        finally:
+            executor.shutdown(wait=True)
+
+    def start(self):
+        '''
+        Runs the poller in a background thread.
+        '''
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=True):
+        '''
+        Stops the poller, by default waiting for the running polls.
+        '''
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,139 @@
+import time
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from UbiquitiManager.UbiExceptions import UbiHostException
+
+
+class UbiResolver(object):
+    '''
+    Host name resolver with a time bound cache, able to resolve a whole
+    inventory concurrently. Failures are cached for a shorter time.
+
+    Attributes
+    ----------
+    ttl : float
+        Seconds a resolved address is kept.
+    negative_ttl : float
+        Seconds a resolution failure is kept.
+    max_workers : int
+        Maximum number of simultaneous lookups in resolve_many.
+
+    Methods
+    -------
+    resolve(host)
+        Returns the address of host.
+    resolve_many(hosts)
+        Resolves many hosts concurrently.
+    '''
+    def __init__(self, ttl=300, negative_ttl=30, max_workers=32):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_workers = max_workers
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, host):
+        with self._lock:
+            entry = self._cache.get(host)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry
+
+    def resolve(self, host):
+        '''
+        Returns the address of host, from the cache when possible.
+
+        Raises
+        ------
+        UbiHostException
+            If the host can not be resolved.
+        '''
+        host = str(host)
+        entry = self._cached(host)
+        if entry is None:
+            try:
+                entry = (time.time() + self.ttl, socket.gethostbyname(host))
+            except socket.gaierror:
+                entry = (time.time() + self.negative_ttl, None)
+            with self._lock:
+                self._cache[host] = entry
+        if entry[1] is None:
+            raise UbiHostException('enable to resolve given host')
+        return entry[1]
+
+    def resolve_many(self, hosts):
+        '''
+        Resolves hosts concurrently, cached ones are not looked up again.
+
+        Parameters
+        ----------
+        hosts : iterable
+            Host names or addresses.
+
+        Returns
+        -------
+        addresses : dict
+            Address of each host, or the UbiHostException raised for it.
+        '''
+        def resolve(host):
+            try:
+                return self.resolve(host)
+            except UbiHostException as excpt:
+                return excpt
+        hosts = set(str(host) for host in hosts)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(hosts, executor.map(resolve, hosts)))
+
+    def clear(self):
+        '''
+        Empties the cache.
+        '''
+        with self._lock:
+            self._cache.clear()
+
+
+DEFAULT_RESOLVER = UbiResolver()
+
+
+def load_inventory(inventory, resolver=None, **defaults):
+    '''
+    Normalizes an inventory and resolves all its hosts concurrently.
+
+    Parameters
+    ----------
+    inventory : iterable
+        Host names, or dict of UbiConnector parameters with at least host.
+    resolver : UbiResolver, optional
+        Resolver to use, DEFAULT_RESOLVER by default.
+    defaults : dict
+        Parameters added to every entry when missing.
+
+    Returns
+    -------
+    entries : list
+        One dict per device, with 'address' set to the resolved address,
+        or None and 'error' set to the UbiHostException when it failed.
+    '''
+    resolver = resolver or DEFAULT_RESOLVER
+    entries = []
+    for item in inventory:
+        entry = dict(defaults)
+        if isinstance(item, dict):
+            entry.update(item)
+        else:
+            entry['host'] = str(item)
+        entries.append(entry)
+    addresses = resolver.resolve_many(
+        entry['host'] for entry in entries if not entry.get('address')
+    )
+    for entry in entries:
+        if entry.get('address'):
+            continue
+        address = addresses[str(entry['host'])]
+        if isinstance(address, UbiHostException):
+            entry['address'] = None
+            entry['error'] = address
+        else:
+            entry['address'] = address
+    return entries
@@ -0,0 +1,107 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class UbiResponseCache(object):
+    '''
+    Bounded cache of GET results with a time to live per path and least
+    recently used eviction. Entries are keyed by device and path, so one
+    cache can be shared by several connectors to the same device.
+
+    Attributes
+    ----------
+    ttls : dict
+        Seconds a result stays valid, by path (without the query string).
+        Paths not listed use default_ttl.
+    default_ttl : float
+        Time to live of other paths, 0 means they are not cached.
+    max_entries : int
+        Above this number of entries the least recently used is dropped.
+    stats : dict
+        Counters of hits, misses, expired and evicted entries. Paths which
+        are not cached are not counted.
+
+    Methods
+    -------
+    get(key, path)
+        Returns (True, result) on hit, (False, None) on miss.
+    put(key, path, result)
+        Stores a result if its path is cacheable.
+    invalidate(key=None)
+        Drops the entries of a device, or all of them.
+    '''
+    def __init__(self, ttls=None, default_ttl=0, max_entries=1024):
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ttl(self, path):
+        '''
+        Returns the time to live of path.
+        '''
+        if path in self.ttls:
+            return self.ttls[path]
+        return self.ttls.get(path.split('?')[0], self.default_ttl)
+
+    def get(self, key, path):
+        '''
+        Looks for a valid result.
+
+        Parameters
+        ----------
+        key : tuple
+            Device identifier, like (host, port).
+        path : str
+            Requested path.
+
+        Returns
+        -------
+        hit : bool
+            True if a valid result was found.
+        result : dict or str
+            The cached result, shared with other callers: do not modify it.
+        '''
+        if not self.ttl(path):
+            return False, None
+        with self._lock:
+            entry = self._entries.get((key, path))
+            if entry is None:
+                self.stats['misses'] += 1
+                return False, None
+            if entry[0] < time.time():
+                del self._entries[(key, path)]
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return False, None
+            self._entries.move_to_end((key, path))
+            self.stats['hits'] += 1
+            return True, entry[1]
+
+    def put(self, key, path, result):
+        '''
+        Stores result if path has a time to live.
+        '''
+        ttl = self.ttl(path)
+        if not ttl or ttl <= 0:
+            return
+        with self._lock:
+            self._entries[(key, path)] = (time.time() + ttl, result)
+            self._entries.move_to_end((key, path))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evicted'] += 1
+
+    def invalidate(self, key=None):
+        '''
+        Drops the entries of the device identified by key, or all entries.
+        '''
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                return
+            for entry_key in [k for k in self._entries if k[0] == key]:
+                del self._entries[entry_key]
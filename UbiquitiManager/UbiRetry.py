@@ -0,0 +1,199 @@
+import time
+import threading
+from UbiquitiManager.UbiBackoff import backoff_delays
+from UbiquitiManager.UbiExceptions import UbiCircuitOpen
+
+# Answers worth asking again: the web server of the device is overloaded
+# or restarting.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class UbiRetryPolicy(object):
+    '''
+    Tells UbiConnector when and after how long a request is sent again:
+    only idempotent methods (GET), when the connection failed or the
+    device answered with a 5xx status, with exponentially growing delays
+    randomly shortened so a fleet does not retry in sync. Only failures
+    to connect are retried: after a read time out or an aborted connection
+    the device may have acted on the request. GETs which are not
+    idempotent are sent with retry=False (see UbiConnector.ubi_request_get).
+
+    Attributes
+    ----------
+    retries : int
+        Number of times a request is sent again, 0 disables retries.
+    initial, maximum, factor, jitter : float
+        See UbiBackoff.backoff_delays.
+    statuses : tuple
+        HTTP statuses retried.
+    methods : tuple
+        HTTP methods retried, GET only by default: a failed POST may have
+        been applied by the device.
+
+    Methods
+    -------
+    delays()
+        Returns the delays to sleep before each retry.
+    retry_status(method, status)
+        Tells if an answer with this status should be asked again.
+    retry_error(method)
+        Tells if a request which failed to connect should be sent again.
+    '''
+
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, retries=2, initial=0.5, maximum=5, factor=2,
+                 jitter=0.5, statuses=RETRY_STATUSES, methods=('GET',)):
+        self.retries = retries
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.statuses = tuple(statuses)
+        self.methods = tuple(method.upper() for method in methods)
+
+    def delays(self):
+        '''
+        Returns the list of delays to sleep before each retry, one per
+        retry.
+        '''
+        delays = backoff_delays(
+            self.initial,
+            self.maximum,
+            self.factor,
+            self.jitter
+        )
+        return [next(delays) for _ in range(self.retries)]
+
+    def retry_status(self, method, status):
+        '''
+        Tells if an answer with this HTTP status should be asked again.
+        '''
+        return method.upper() in self.methods and status in self.statuses
+
+    def retry_error(self, method):
+        '''
+        Tells if a request which could not connect should be sent again.
+        '''
+        return method.upper() in self.methods
+
+
+class UbiCircuitBreaker(object):
+    '''
+    Remembers the devices which recently failed to answer (connection
+    errors and timeouts) so requests to them fail fast with UbiCircuitOpen
+    instead of waiting for their timeouts again. Give the same breaker to
+    all the connectors of a sweep (breaker parameter, also through UbiFleet
+    or UbiPoller connector options).
+
+    After failure_threshold consecutive failures the circuit of the device
+    opens. Once reset_timeout seconds went by, one request is let through:
+    an answer closes the circuit, a failure opens it for reset_timeout
+    more seconds. Connectors name hosts like UbiMetrics does, hostname
+    followed by ':port' when the port is not 80 or 443.
+
+    Attributes
+    ----------
+    failure_threshold : int
+        Consecutive failures opening the circuit.
+    reset_timeout : float
+        Seconds requests are refused before one is tried again.
+
+    Methods
+    -------
+    check(host)
+        Raises UbiCircuitOpen if requests to host are refused.
+    success(host)
+        Records an answer of host, closing its circuit.
+    failure(host)
+        Records a failure of host.
+    state(host)
+        Returns 'closed', 'open' or 'half_open'.
+    open_hosts()
+        Returns the hosts whose circuit is open.
+    reset(host=None)
+        Forgets the failures of host, or of all hosts.
+    '''
+    def __init__(self, failure_threshold=3, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def check(self, host):
+        '''
+        Lets a request to host through, or refuses it.
+
+        Raises
+        ------
+        UbiCircuitOpen
+            If host failed failure_threshold times in a row less than
+            reset_timeout seconds ago, or another request is already
+            trying it again.
+        '''
+        now = time.time()
+        with self._lock:
+            failures = self._hosts.get(host)
+            if failures is None or failures[0] < self.failure_threshold:
+                return
+            if now - failures[1] < self.reset_timeout:
+                raise UbiCircuitOpen(
+                    '{} failed {} times, retrying in {:.1f}s'.format(
+                        host,
+                        failures[0],
+                        failures[1] + self.reset_timeout - now
+                    )
+                )
+            # This request tries the device again, the others keep failing
+            # fast until it answers or reset_timeout is over again.
+            failures[1] = now
+
+    def success(self, host):
+        '''
+        Records that host answered, closing its circuit.
+        '''
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def failure(self, host):
+        '''
+        Records that host failed to answer.
+        '''
+        with self._lock:
+            failures = self._hosts.setdefault(host, [0, 0.0])
+            failures[0] += 1
+            failures[1] = time.time()
+
+    def state(self, host):
+        '''
+        Returns the state of the circuit of host: 'closed' when requests
+        are sent, 'open' when they are refused, 'half_open' when the next
+        one will be tried.
+        '''
+        with self._lock:
+            failures = self._hosts.get(host)
+            if failures is None or failures[0] < self.failure_threshold:
+                return 'closed'
+            if time.time() - failures[1] < self.reset_timeout:
+                return 'open'
+            return 'half_open'
+
+    def open_hosts(self):
+        '''
+        Returns the hosts whose circuit is open or half open.
+        '''
+        with self._lock:
+            return sorted(
+                host for host, failures in self._hosts.items()
+                if failures[0] >= self.failure_threshold
+            )
+
+    def reset(self, host=None):
+        '''
+        Forgets the failures of host, or of every host.
+        '''
+        with self._lock:
+            if host is None:
+                self._hosts.clear()
+            else:
+                self._hosts.pop(host, None)
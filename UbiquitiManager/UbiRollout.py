@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import threading
+from UbiquitiManager.UbiFleet import UbiFleet
+from UbiquitiManager.UbiFleet import entry_key
+from UbiquitiManager.UbiConfigManager import UbiConfigManager
+from UbiquitiManager.UbiExceptions import UbiRolloutHalted
+from UbiquitiManager.UbiUpload import UbiRateLimiter
+
+
+class UbiRollout(object):
+    '''
+    UbiRollout upgrades the firmware of a fleet by waves. The first waves
+    are small canaries, each wave runs its upgrades concurrently with a
+    limit of simultaneous uploads per site (uplink), and the rollout halts
+    when too many devices fail. Progress is saved in a state file after
+    each device so an interrupted rollout resumes where it stopped.
+    Devices are tracked by UbiFleet.entry_key: host, with ':port' when it
+    is not 80 or 443, or the 'id' of their inventory entry.
+
+    Attributes
+    ----------
+    inventory : list
+        List of host names or dict of UbiConnector parameters, a 'site' key
+        groups devices sharing an uplink.
+    firmware : str
+        Path to the firmware image.
+    state_file : str
+        Path to the JSON file holding the rollout progress.
+    waves : list
+        Size of the successive waves, the last one is repeated until every
+        device is handled.
+    max_uploads_per_site : int
+        Maximum simultaneous uploads to devices of the same site. Devices
+        without site are only bounded by max_workers.
+    max_failure_rate : float
+        Failed devices over devices handled by the current run ratio above
+        which the rollout halts, checked after each wave.
+    max_workers : int
+        Maximum number of devices upgraded at the same time.
+    upload_rate_limit : float
+        Bytes per second cap of each upload, None for no cap.
+    total_rate_limit : float
+        Bytes per second cap of all the uploads together, None for no cap.
+    state : dict
+        Current progress, as saved in state_file.
+
+    Methods
+    -------
+    run(callback=None)
+        Runs or resumes the rollout.
+    pending()
+        Returns the inventory entries still to upgrade.
+    '''
+
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, inventory, firmware, state_file, waves=(1, 10, 100),
+                 max_uploads_per_site=2, max_failure_rate=0.1,
+                 max_workers=32, upload_rate_limit=None,
+                 total_rate_limit=None, upgrade_options=None,
+                 **connector_options):
+        self.fleet = UbiFleet(
+            inventory,
+            max_workers=max_workers,
+            **connector_options
+        )
+        self.inventory = self.fleet.inventory
+        self.firmware = firmware
+        self.state_file = state_file
+        self.waves = list(waves)
+        self.max_uploads_per_site = max_uploads_per_site
+        self.max_failure_rate = max_failure_rate
+        self.max_workers = max_workers
+        self.upload_rate_limit = upload_rate_limit
+        self.total_rate_limit = total_rate_limit
+        self._total_limiter = None
+        if total_rate_limit:
+            self._total_limiter = UbiRateLimiter(total_rate_limit)
+        self.upgrade_options = upgrade_options or {}
+        self._lock = threading.Lock()
+        self._slots = {}
+        self.state = {'firmware': firmware, 'hosts': {}, 'halted': False}
+        if os.path.exists(state_file):
+            with open(state_file) as state:
+                saved_state = json.load(state)
+            if saved_state.get('firmware') == firmware:
+                self.state = saved_state
+
+    def _save(self):
+        tmp_path = '{}.tmp'.format(self.state_file)
+        with open(tmp_path, 'w') as state:
+            json.dump(self.state, state, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_file)
+
+    def _slot(self, site):
+        if site is None:
+            return None
+        with self._lock:
+            if site not in self._slots:
+                self._slots[site] = threading.BoundedSemaphore(
+                    self.max_uploads_per_site
+                )
+            return self._slots[site]
+
+    def _upgrade(self, connector, entry):
+        result = UbiConfigManager(connector).fw_upgrade(
+            self.firmware,
+            upload_slot=self._slot(entry.get('site')),
+            rate_limit=[self.upload_rate_limit, self._total_limiter],
+            **self.upgrade_options
+        )
+        return dict(result._asdict())
+
+    def _record(self, result):
+        with self._lock:
+            if result.error is None:
+                self.state['hosts'][result.key] = {
+                    'status': 'done',
+                    'timings': result.result,
+                    'finished': time.time(),
+                }
+            else:
+                self.state['hosts'][result.key] = {
+                    'status': 'failed',
+                    'error': '{}: {}'.format(
+                        type(result.error).__name__,
+                        str(result.error)
+                    ),
+                    'finished': time.time(),
+                }
+            self._save()
+
+    def pending(self):
+        '''
+        Returns the inventory entries not upgraded yet, failed devices
+        included.
+        '''
+        hosts = self.state['hosts']
+        return [
+            entry for entry in self.inventory
+            if hosts.get(entry_key(entry), {}).get('status') != 'done'
+        ]
+
+    def _failure_rate(self, handled):
+        statuses = [self.state['hosts'][host]['status'] for host in handled]
+        if not statuses:
+            return 0
+        return statuses.count('failed') / float(len(statuses))
+
+    def run(self, callback=None):
+        '''
+        Runs the rollout, or resumes it from state_file.
+
+        Parameters
+        ----------
+        callback : callable, optional
+            Called with each UbiFleetResult as devices complete.
+
+        Returns
+        -------
+        state : dict
+            Final progress of the rollout.
+
+        Raises
+        ------
+        UbiRolloutHalted
+            If the failure rate went over max_failure_rate after a wave.
+        '''
+        self.state['halted'] = False
+        pending = self.pending()
+        handled = set()
+        wave_index = 0
+        while pending:
+            size = self.waves[min(wave_index, len(self.waves) - 1)]
+            wave, pending = pending[:size], pending[size:]
+            wave_index += 1
+            self.fleet.inventory = wave
+            for result in self.fleet.run(self._upgrade, with_entry=True):
+                self._record(result)
+                handled.add(result.key)
+                if callback is not None:
+                    callback(result)
+            failure_rate = self._failure_rate(handled)
+            if failure_rate > self.max_failure_rate:
+                self.state['halted'] = True
+                self._save()
+                raise UbiRolloutHalted(
+                    'Rollout halted after wave {}, failure rate {:.0%}'.format(
+                        wave_index,
+                        failure_rate
+                    )
+                )
+        return self.state
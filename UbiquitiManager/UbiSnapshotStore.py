@@ -0,0 +1,319 @@
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from UbiquitiManager.UbiConfigStore import UbiConfigStore
+
+# Number of ids per "IN (...)" query, below the SQLite parameter limit.
+_CHUNK = 500
+# Manifests are packed as 64 bits signed ids, the same on every platform.
+_ID_TYPECODE = 'q'
+
+
+class UbiSnapshotStore(object):
+    '''
+    Archive of device configurations in a SQLite database, deduplicated at
+    the line level: each distinct line is stored once, addressed by its
+    digest, and a snapshot is the packed list of its line ids (identical
+    configurations share the same list). An index of key changes answers
+    when a key changed on a device without reading the snapshots. The ids
+    of the lines already seen are kept in memory, so saving a config whose
+    lines are all known only hashes the line list.
+
+    Snapshots of a device must be saved in time order.
+
+    Attributes
+    ----------
+    path : str
+        Path to the SQLite database.
+
+    Methods
+    -------
+    save(host, config, timestamp=None)
+        Archives a configuration.
+    load(host, timestamp=None)
+        Returns the configuration of a device at a given time.
+    history(host, key)
+        Returns when a key changed on a device, and its values.
+    snapshots(host)
+        Returns the snapshot times of a device.
+    hosts()
+        Returns the archived devices.
+    stats()
+        Returns the number of lines, manifests and snapshots stored.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._line_cache = {}
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS lines '
+                '(id INTEGER PRIMARY KEY, digest BLOB UNIQUE NOT NULL, '
+                'text TEXT NOT NULL)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS manifests '
+                '(id INTEGER PRIMARY KEY, digest BLOB UNIQUE NOT NULL, '
+                'lines BLOB NOT NULL)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS snapshots '
+                '(host TEXT NOT NULL, timestamp REAL NOT NULL, '
+                'manifest INTEGER NOT NULL, PRIMARY KEY (host, timestamp))'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS key_changes '
+                '(host TEXT NOT NULL, key TEXT NOT NULL, '
+                'timestamp REAL NOT NULL, value TEXT)'
+            )
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS key_changes_index '
+                'ON key_changes (host, key, timestamp)'
+            )
+
+    def _line_ids(self, lines):
+        '''
+        Returns the ids of lines, inserting the unknown ones, and the ids
+        found outside the cache, to be cached once the transaction commits.
+        '''
+        cache = self._line_cache
+        missing = {}
+        found = {}
+        for line in lines:
+            if line not in cache and line not in missing:
+                missing[line] = hashlib.sha1(line.encode('utf-8')).digest()
+        if missing:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO lines (text, digest) VALUES (?, ?)',
+                missing.items()
+            )
+            lines_of = {digest: line for line, digest in missing.items()}
+            digests = list(lines_of)
+            for start in range(0, len(digests), _CHUNK):
+                chunk = digests[start:start + _CHUNK]
+                for digest, line_id in self._db.execute(
+                        'SELECT digest, id FROM lines WHERE digest IN '
+                        '({})'.format(','.join('?' * len(chunk))),
+                        chunk):
+                    found[lines_of[digest]] = line_id
+        return [
+            found[line] if line in found else cache[line] for line in lines
+        ], found
+
+    def _texts(self, ids):
+        ids = list(set(ids))
+        texts = {}
+        for start in range(0, len(ids), _CHUNK):
+            chunk = ids[start:start + _CHUNK]
+            texts.update(self._db.execute(
+                'SELECT id, text FROM lines WHERE id IN ({})'.format(
+                    ','.join('?' * len(chunk))
+                ),
+                chunk
+            ))
+        return texts
+
+    def _manifest(self, manifest_id):
+        row = self._db.execute(
+            'SELECT lines FROM manifests WHERE id = ?', (manifest_id,)
+        ).fetchone()
+        ids = array(_ID_TYPECODE)
+        ids.frombytes(row[0])
+        return ids
+
+    def _key_values(self, ids):
+        values = {}
+        for text in self._texts(ids).values():
+            key, separator, value = text.partition('=')
+            if separator:
+                values[key] = value
+        return values
+
+    def save(self, host, config, timestamp=None):
+        '''
+        Archives the configuration of a device, and indexes the keys which
+        changed since its previous snapshot.
+
+        Parameters
+        ----------
+        host : str
+            Device name.
+        config : str or UbiConfigStore
+            Configuration, like UbiConfigManager.config or device_store.
+        timestamp : float, optional
+            Time of the configuration, now by default.
+
+        Returns
+        -------
+        changed : int
+            Number of keys added, removed or changed since the previous
+            snapshot of the device, 0 for its first snapshot (whose values
+            are read from the snapshot itself by history).
+
+        Raises
+        ------
+        ValueError
+            If the device already has a snapshot at or after timestamp.
+        '''
+        if isinstance(config, UbiConfigStore):
+            config = config.to_text()
+        if timestamp is None:
+            timestamp = time.time()
+        host = str(host)
+        with self._lock:
+            with self._db:
+                changed, found = self._save(host, config, timestamp)
+            # Only once committed: a rolled back transaction must not leave
+            # ids of lines which are not in the database.
+            self._line_cache.update(found)
+        return changed
+
+    def _save(self, host, config, timestamp):
+        '''
+        Stores a snapshot in the current transaction, returns the number of
+        keys changed and the line ids to cache.
+        '''
+        previous = self._db.execute(
+            'SELECT timestamp, manifest FROM snapshots WHERE host = ? '
+            'ORDER BY timestamp DESC LIMIT 1', (host,)
+        ).fetchone()
+        if previous is not None and previous[0] >= timestamp:
+            raise ValueError(
+                '{} already has a snapshot at {}'.format(host, previous[0])
+            )
+        ids, found = self._line_ids(str(config).split('\n'))
+        packed = array(_ID_TYPECODE, ids).tobytes()
+        digest = hashlib.sha1(packed).digest()
+        self._db.execute(
+            'INSERT OR IGNORE INTO manifests (digest, lines) '
+            'VALUES (?, ?)', (digest, packed)
+        )
+        manifest_id = self._db.execute(
+            'SELECT id FROM manifests WHERE digest = ?', (digest,)
+        ).fetchone()[0]
+        self._db.execute(
+            'INSERT INTO snapshots VALUES (?, ?, ?)',
+            (host, timestamp, manifest_id)
+        )
+        if previous is None or previous[1] == manifest_id:
+            return 0, found
+        old_ids = set(self._manifest(previous[1]))
+        new_ids = set(ids)
+        old_values = self._key_values(old_ids - new_ids)
+        new_values = self._key_values(new_ids - old_ids)
+        changes = [
+            (host, key, timestamp, new_values.get(key))
+            for key in set(old_values).union(new_values)
+            if old_values.get(key) != new_values.get(key)
+        ]
+        self._db.executemany(
+            'INSERT INTO key_changes VALUES (?, ?, ?, ?)', changes
+        )
+        return len(changes), found
+
+    def load(self, host, timestamp=None):
+        '''
+        Rebuilds the configuration of a device as it was at timestamp (its
+        last snapshot before it), use UbiConfigStore.from_text to query it.
+
+        Parameters
+        ----------
+        host : str
+            Device name.
+        timestamp : float, optional
+            Time of the wanted configuration, the latest by default.
+
+        Returns
+        -------
+        config : str
+            The configuration text, identical to the saved one.
+
+        Raises
+        ------
+        KeyError
+            If the device has no snapshot before timestamp.
+        '''
+        if timestamp is None:
+            timestamp = float('inf')
+        with self._lock:
+            row = self._db.execute(
+                'SELECT manifest FROM snapshots WHERE host = ? AND '
+                'timestamp <= ? ORDER BY timestamp DESC LIMIT 1',
+                (str(host), timestamp)
+            ).fetchone()
+            if row is None:
+                raise KeyError(host)
+            ids = self._manifest(row[0])
+            texts = self._texts(ids)
+        return '\n'.join(texts[line_id] for line_id in ids)
+
+    def history(self, host, key):
+        '''
+        Returns the changes of a key on a device, from the index and the
+        first snapshot of the device.
+
+        Returns
+        -------
+        changes : list
+            (timestamp, value) in time order, value being None when the key
+            was removed. The first one is the value in the first snapshot,
+            if the key was there.
+        '''
+        host = str(host)
+        with self._lock:
+            first = self._db.execute(
+                'SELECT timestamp, manifest FROM snapshots WHERE host = ? '
+                'ORDER BY timestamp LIMIT 1', (host,)
+            ).fetchone()
+            if first is None:
+                return []
+            changes = self._db.execute(
+                'SELECT timestamp, value FROM key_changes WHERE host = ? AND '
+                'key = ? ORDER BY timestamp', (host, key)
+            ).fetchall()
+            value = self._key_values(self._manifest(first[1])).get(key)
+        if value is not None:
+            changes.insert(0, (first[0], value))
+        return changes
+
+    def snapshots(self, host):
+        '''
+        Returns the snapshot times of a device, in order.
+        '''
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT timestamp FROM snapshots WHERE host = ? '
+                'ORDER BY timestamp', (str(host),)
+            )]
+
+    def hosts(self):
+        '''
+        Returns the devices having snapshots.
+        '''
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT DISTINCT host FROM snapshots ORDER BY host'
+            )]
+
+    def stats(self):
+        '''
+        Returns the number of distinct lines, distinct configurations
+        (manifests) and snapshots stored.
+        '''
+        with self._lock:
+            return {
+                table: self._db.execute(
+                    'SELECT COUNT(*) FROM {}'.format(table)
+                ).fetchone()[0]
+                for table in ('lines', 'manifests', 'snapshots')
+            }
+
+    def close(self):
+        '''
+        Closes the database.
+        '''
+        with self._lock:
+            self._db.close()
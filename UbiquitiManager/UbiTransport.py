@@ -0,0 +1,177 @@
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from UbiquitiManager.UbiExceptions import UbiTimeoutException
+
+
+class _UbiDevicePool(object):
+    '''
+    Connection pool and in-flight request cap of one device.
+    '''
+    def __init__(self, max_per_host):
+        self.adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_per_host,
+            pool_block=True
+        )
+        self.semaphore = threading.BoundedSemaphore(max_per_host)
+        self.stats = {
+            'requests': 0,
+            'queued': 0,
+            'wait_time': 0.0,
+            'max_wait': 0.0,
+            'in_flight': 0,
+            'max_in_flight': 0,
+        }
+
+
+class UbiTransport(object):
+    '''
+    Connection pools shared by UbiConnector instances: one pool per device
+    (protocol, address, port), mounted on the session of every connector
+    to that device, so keep-alive connections are reused across
+    connectors, and a cap on the requests sent at once to a device. Extra
+    requests wait for a free slot instead of piling up on the small
+    embedded web server of the device.
+
+    Give the same transport to all the connectors (transport parameter,
+    also through UbiFleet or UbiPoller connector options).
+
+    Attributes
+    ----------
+    max_per_host : int
+        Maximum number of requests in flight, and of opened connections,
+        to a single device.
+    acquire_timeout : float
+        Seconds a request may wait for a slot before UbiTimeoutException
+        is raised, None to wait as long as needed.
+    max_idle_devices : int
+        Above this number of devices, the connections of the least
+        recently used idle devices are closed.
+
+    Methods
+    -------
+    mount(session, protocol, host, port)
+        Makes session use the shared pool of the device.
+    slot(protocol, host, port)
+        Context manager holding one request slot of the device.
+    stats()
+        Returns the queueing counters of each device.
+    totals()
+        Returns the queueing counters summed over all devices.
+    close()
+        Closes all the pooled connections.
+    '''
+    def __init__(self, max_per_host=2, acquire_timeout=None,
+                 max_idle_devices=1024):
+        self.max_per_host = max_per_host
+        self.acquire_timeout = acquire_timeout
+        self.max_idle_devices = max_idle_devices
+        self._devices = {}
+        self._used = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(protocol, host, port):
+        return '{}://{}:{}'.format(protocol, host, port)
+
+    def _device(self, key):
+        with self._lock:
+            device = self._devices.get(key)
+            if device is None:
+                device = self._devices[key] = _UbiDevicePool(
+                    self.max_per_host
+                )
+            self._used[key] = device
+            self._used.move_to_end(key)
+            while len(self._used) > self.max_idle_devices:
+                other, idle = self._used.popitem(last=False)
+                if idle.stats['in_flight']:
+                    self._used[other] = idle
+                    break
+                idle.adapter.close()
+            return device
+
+    def mount(self, session, protocol, host, port):
+        '''
+        Mounts the pool of the device on a requests session: requests to
+        the device made with the session go through the shared pool.
+        '''
+        key = self._key(protocol, host, port)
+        session.mount(key + '/', self._device(key).adapter)
+
+    @contextmanager
+    def slot(self, protocol, host, port):
+        '''
+        Waits for a free request slot of the device and holds it.
+
+        Raises
+        ------
+        UbiTimeoutException
+            If no slot was freed within acquire_timeout seconds.
+        '''
+        key = self._key(protocol, host, port)
+        device = self._device(key)
+        start = time.time()
+        queued = not device.semaphore.acquire(False)
+        if queued:
+            timeout = self.acquire_timeout
+            if not device.semaphore.acquire(timeout=timeout):
+                raise UbiTimeoutException(
+                    'No request slot for {} after {}s'.format(key, timeout)
+                )
+        wait = time.time() - start
+        with self._lock:
+            stats = device.stats
+            stats['requests'] += 1
+            stats['queued'] += queued
+            stats['wait_time'] += wait
+            stats['max_wait'] = max(stats['max_wait'], wait)
+            stats['in_flight'] += 1
+            stats['max_in_flight'] = max(
+                stats['max_in_flight'],
+                stats['in_flight']
+            )
+        try:
+            yield
+        finally:
+            with self._lock:
+                device.stats['in_flight'] -= 1
+            device.semaphore.release()
+
+    def stats(self):
+        '''
+        Returns the counters of each device, keyed by protocol://host:port:
+        requests sent, requests which had to wait (queued), total and
+        maximum wait in seconds, requests in flight and their maximum.
+        '''
+        with self._lock:
+            return {
+                key: dict(device.stats)
+                for key, device in self._devices.items()
+            }
+
+    def totals(self):
+        '''
+        Returns the counters of stats summed over all devices (maximums
+        are the maximum over devices).
+        '''
+        totals = {}
+        for stats in self.stats().values():
+            for name, value in stats.items():
+                if name.startswith('max_'):
+                    totals[name] = max(totals.get(name, 0), value)
+                else:
+                    totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def close(self):
+        '''
+        Closes all the pooled connections.
+        '''
+        with self._lock:
+            for device in self._devices.values():
+                device.adapter.close()
+            self._used.clear()
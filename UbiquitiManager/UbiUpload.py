@@ -0,0 +1,238 @@
+import os
+import io
+import time
+import mmap
+import uuid
+import threading
+
+
+class UbiRateLimiter(object):
+    '''
+    Token bucket bounding the bytes per second sent through it. One
+    instance can be shared by many uploads to cap their total bandwidth.
+
+    Attributes
+    ----------
+    rate : float
+        Bytes per second allowed.
+    burst : float
+        Bytes that may be sent at once after an idle period.
+
+    Methods
+    -------
+    consume(amount)
+        Blocks until amount bytes may be sent.
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        '''
+        Reserves amount bytes and sleeps until they may be sent.
+        '''
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= amount
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class UbiFirmwareImage(object):
+    '''
+    Firmware image mapped read-only in memory. Images are shared: get()
+    returns the same mapping for every upload of the same file, so N
+    parallel upgrades hold a single copy of the image.
+
+    Attributes
+    ----------
+    path : str
+        Path to the firmware file.
+    view : memoryview
+        Read-only view over the mapped image.
+
+    Methods
+    -------
+    get(path)
+        Returns the shared image of the file.
+    '''
+    _images = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fwfile:
+            self._map = mmap.mmap(fwfile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self._map)
+
+    def __len__(self):
+        return len(self.view)
+
+    @classmethod
+    def get(cls, path):
+        '''
+        Returns the shared image of the file, mapping it on first use or
+        when the file changed on disk.
+
+        Parameters
+        ----------
+        path : str
+            Path to the firmware file.
+        '''
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime, stat.st_size)
+        with cls._lock:
+            if key not in cls._images:
+                for old_key in [k for k in cls._images if k[0] == path]:
+                    del cls._images[old_key]
+                cls._images[key] = cls(path)
+            return cls._images[key]
+
+
+class UbiMultipartEncoder(object):
+    '''
+    File like multipart/form-data body, produced while it is read instead
+    of being encoded in memory. File fields are read by chunks from
+    UbiFirmwareImage, bytes or file objects, and the sending is throttled
+    by the given rate limiters.
+
+    Attributes
+    ----------
+    content_type : str
+        Value of the Content-Type header for the request.
+    sent : int
+        Bytes read so far.
+
+    Methods
+    -------
+    read(size=-1)
+        Returns the next bytes of the body.
+    rewind()
+        Restarts the body from its beginning, to send it again.
+    '''
+    def __init__(self, fields, limiters=None, progress=None,
+                 chunk_size=65536):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(
+            self.boundary
+        )
+        self.limiters = [limiter for limiter in limiters or [] if limiter]
+        self.progress = progress
+        self.chunk_size = chunk_size
+        self._parts = []
+        for name, value in fields.items():
+            filename = None
+            if isinstance(value, tuple):
+                filename, value = value
+            self._add_part(name, filename, value)
+        self._parts.append(
+            io.BytesIO('--{}--\r\n'.format(self.boundary).encode())
+        )
+        self._starts = [part.tell() for part in self._parts]
+        self._lengths = [self._length(part) for part in self._parts]
+        self._len = sum(self._lengths)
+        self.rewind()
+
+    def _add_part(self, name, filename, value):
+        header = '--{}\r\nContent-Disposition: form-data; name="{}"'.format(
+            self.boundary,
+            name
+        )
+        if filename is not None:
+            header += '; filename="{}"\r\n' \
+                'Content-Type: application/octet-stream'.format(filename)
+        self._parts.append(io.BytesIO('{}\r\n\r\n'.format(header).encode()))
+        if isinstance(value, UbiFirmwareImage):
+            value = value.view
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        if isinstance(value, (bytes, memoryview)):
+            value = _ViewReader(value)
+        self._parts.append(value)
+        self._parts.append(io.BytesIO(b'\r\n'))
+
+    @staticmethod
+    def _length(part):
+        if isinstance(part, _ViewReader):
+            return len(part.view)
+        start = part.tell()
+        end = part.seek(0, os.SEEK_END)
+        part.seek(start)
+        return end - start
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        chunk = self.read(self.chunk_size)
+        while chunk:
+            yield chunk
+            chunk = self.read(self.chunk_size)
+
+    def rewind(self):
+        '''
+        Restarts the body from its beginning.
+        '''
+        for part, start in zip(self._parts, self._starts):
+            part.seek(start)
+        self._index = 0
+        self._remaining = self._lengths[0]
+        self.sent = 0
+
+    def read(self, size=-1):
+        '''
+        Returns at most size bytes (chunk_size if size is not given) of the
+        body, an empty bytes once it is complete.
+        '''
+        if size is None or size < 0:
+            size = self.chunk_size
+        while self._index < len(self._parts) and not self._remaining:
+            self._index += 1
+            if self._index < len(self._parts):
+                self._remaining = self._lengths[self._index]
+        if self._index >= len(self._parts):
+            return b''
+        chunk = self._parts[self._index].read(min(size, self._remaining))
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        self._remaining -= len(chunk)
+        for limiter in self.limiters:
+            limiter.consume(len(chunk))
+        self.sent += len(chunk)
+        if self.progress is not None:
+            self.progress(self.sent, self._len)
+        return chunk
+
+
+class _ViewReader(object):
+    '''
+    Minimal file interface over bytes or a memoryview, without copying
+    more than the chunk being read.
+    '''
+    def __init__(self, view):
+        self.view = memoryview(view)
+        self.position = 0
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            position += len(self.view)
+        self.position = position
+        return position
+
+    def read(self, size):
+        chunk = bytes(self.view[self.position:self.position + size])
+        self.position += len(chunk)
+        return chunk
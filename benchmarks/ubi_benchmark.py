@@ -0,0 +1,296 @@
+'''
+Benchmarks of the connector and config paths against UbiFakeDevice, the
+fake devices being served by a separate process.
+
+Results are saved as JSON, and can be compared with a previous run:
+
+    python benchmarks/ubi_benchmark.py --output new.json --compare old.json
+'''
+import sys
+import json
+import time
+import argparse
+import platform
+import multiprocessing
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import UbiquitiManager
+from UbiquitiManager.UbiFakeDevice import fake_config
+from UbiquitiManager.UbiFakeDevice import UbiFakeServer
+from UbiquitiManager.UbiConnector import UbiConnector
+from UbiquitiManager.UbiConfigStore import UbiConfigStore
+from UbiquitiManager.UbiConfigManager import UbiConfigManager
+from UbiquitiManager.UbiCredentialCache import UbiCredentialCache
+from UbiquitiManager.UbiFleet import UbiFleet
+from UbiquitiManager.UbiFleet import fleet_status
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _serve(count, device_options, pipe):
+    server = UbiFakeServer.fleet(count, **device_options)
+    pipe.send(server.inventory())
+    pipe.recv()
+    server.stop()
+
+
+class FakeFleetProcess(object):
+    '''
+    Runs UbiFakeServer.fleet in a child process, so the served devices do
+    not compete with the benchmarked code for the interpreter.
+    '''
+    def __init__(self, count, **device_options):
+        self._pipe, child_pipe = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_serve,
+            args=(count, device_options, child_pipe)
+        )
+        self._process.daemon = True
+        self._process.start()
+        self.inventory = self._pipe.recv()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._pipe.send('stop')
+        self._process.join()
+
+
+def summary(durations):
+    '''
+    Returns count, total and mean/median/95th percentile in milliseconds
+    of a list of durations in seconds.
+    '''
+    durations = sorted(durations)
+    count = len(durations)
+    return {
+        'count': count,
+        'total_s': sum(durations),
+        'mean_ms': sum(durations) / count * 1000,
+        'p50_ms': durations[count // 2] * 1000,
+        'p95_ms': durations[min(count - 1, int(count * 0.95))] * 1000,
+    }
+
+
+def timed(function, repeat):
+    '''
+    Calls function repeat times and returns the summary of the durations.
+    '''
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return summary(durations)
+
+
+def connector(entry, **options):
+    '''
+    Returns a UbiConnector to a device of a fake fleet inventory.
+    '''
+    return UbiConnector(
+        entry['host'],
+        entry['login'],
+        entry['password'],
+        protocol=entry['protocol'],
+        port=entry['port'],
+        address=entry['address'],
+        **options
+    )
+
+
+def bench_login(args):
+    '''
+    Forced login on a live session, and first login of a new connector
+    whose first password is wrong, with and without credential hints.
+    '''
+    with FakeFleetProcess(1, latency=args.latency) as fleet:
+        entry = fleet.inventory[0]
+        relogin = connector(entry)
+        relogin.ubi_authentication()
+        cache = UbiCredentialCache()
+
+        def first_login(credential_cache):
+            connector(
+                dict(entry, password=['wrong', entry['password']]),
+                credential_cache=credential_cache
+            ).ubi_authentication()
+        return {
+            'relogin': timed(
+                lambda: relogin.ubi_authentication(force=True), args.repeat
+            ),
+            'first_login': timed(
+                lambda: first_login(UbiCredentialCache()), args.repeat
+            ),
+            'first_login_cached_hint': timed(
+                lambda: first_login(cache), args.repeat
+            ),
+        }
+
+
+def bench_gather_parse(args):
+    '''
+    Download and parse of cfg.cgi, then parse and dict conversion alone.
+    '''
+    results = {}
+    with FakeFleetProcess(1, latency=args.latency,
+                          config_lines=args.config_lines) as fleet:
+        device = connector(fleet.inventory[0])
+        device.ubi_authentication()
+        results['gather_config'] = timed(
+            lambda: UbiConfigManager(device).gather_config(), args.repeat
+        )
+    text = fake_config(lines=args.config_lines)
+    results['parse'] = timed(
+        lambda: UbiConfigStore.from_text(text), args.repeat
+    )
+    results['parse']['lines_per_s'] = \
+        args.config_lines / (results['parse']['mean_ms'] / 1000)
+    results['to_dict'] = timed(
+        lambda: UbiConfigStore.from_text(text).to_dict(), args.repeat
+    )
+    return results
+
+
+def bench_set_value(args):
+    '''
+    set_value on existing keys, and rebuild of the text after edits.
+    '''
+    manager = UbiConfigManager(
+        None,
+        config_text=fake_config(lines=args.config_lines)
+    )
+    keys = manager.store.match('netconf.*.mtu')
+    counter = [0]
+
+    def set_value():
+        counter[0] += 1
+        manager.set_value(keys[counter[0] % len(keys)], str(counter[0]))
+
+    def edit_and_serialize():
+        set_value()
+        return manager.config
+    return {
+        'set_value': timed(set_value, args.repeat * 10),
+        'set_value_and_serialize': timed(edit_and_serialize, args.repeat),
+    }
+
+
+def bench_fleet(args):
+    '''
+    status.cgi on every device of fleets of increasing sizes with UbiFleet,
+    each task logging in with its own connector.
+    '''
+    results = {}
+    for size in args.sizes:
+        with FakeFleetProcess(size, latency=args.latency,
+                              clients=0) as fleet:
+            start = time.perf_counter()
+            fleet_results = UbiFleet(
+                fleet.inventory,
+                max_workers=args.workers,
+                protocol='http'
+            ).run_all(fleet_status)
+            duration = time.perf_counter() - start
+        results[str(size)] = {
+            'total_s': duration,
+            'devices_per_s': size / duration,
+            'errors': sum(1 for result in fleet_results if result.error),
+            'task': summary([result.duration for result in fleet_results]),
+        }
+    return results
+
+
+BENCHMARKS = {
+    'login': bench_login,
+    'gather_parse': bench_gather_parse,
+    'set_value': bench_set_value,
+    'fleet': bench_fleet,
+}
+
+
+def flatten(results, prefix=''):
+    '''
+    Returns the numeric leaves of nested results as {dotted name: value}.
+    '''
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)):
+            values[prefix + key] = value
+    return values
+
+
+def compare(results, baseline):
+    '''
+    Prints each metric of results next to the baseline one and their ratio.
+    '''
+    new = flatten(results['results'])
+    old = flatten(baseline['results'])
+    for name in sorted(new):
+        if name in old and old[name]:
+            print('{:60} {:>12.3f} {:>12.3f} {:>7.2f}x'.format(
+                name, old[name], new[name], new[name] / old[name]
+            ))
+
+
+def main():
+    '''
+    Runs the benchmarks given on the command line.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('benchmarks', nargs='*',
+                        help='among {}, all by default'.format(
+                            ', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='previous results to compare to')
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--sizes', default='100,1000,5000',
+                        help='fleet sizes, comma separated')
+    parser.add_argument('--workers', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--config-lines', type=int, default=1500)
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(',')]
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {}'.format(name))
+    args.benchmarks = args.benchmarks or sorted(BENCHMARKS)
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    results = {
+        'version': UbiquitiManager.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'parameters': {
+            'repeat': args.repeat,
+            'sizes': args.sizes,
+            'workers': args.workers,
+            'latency': args.latency,
+            'config_lines': args.config_lines,
+        },
+        'results': {},
+    }
+    for name in args.benchmarks:
+        print('running {}'.format(name))
+        results['results'][name] = BENCHMARKS[name](args)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -82,7 +82,11 @@ setup(
     #    'dev': ['check-manifest'],
     #    'test': ['coverage'],
     #},
-    extras_require={},
+    extras_require={
+        'async': ['aiohttp'],
+        'analytics': ['numpy'],
+        'fastjson': ['orjson'],
+    },
 
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these